@@ -0,0 +1,245 @@
+"""Benchmark the feature engineering of sts/preprocess.py
+
+Generates synthetic sentence pair corpora in the same tab separated format
+as the input dataset and times each preprocessing stage separately:
+
+parse, tokenize, vectorize, distances, split, scale, impute and write
+
+Every corpus size runs in a fresh process, so the peak RSS reported is the
+one of that size alone. Everything runs on local files, no AWS access is
+needed.
+
+python benchpreprocess.py --sizes 1000 10000 100000 1000000
+
+Results are written to a JSON file (--output), pass a previous results file
+with --compare to fail when a stage is slower than --tolerance allows.
+"""
+from sts.preprocess import (
+    _METRIC_SUBSETS_, read_chunks, tokenize, encode_pairs,
+    distance_features, fit_scaling, _scale, save_split)
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import collections
+import contextlib
+import platform
+import resource
+import tempfile
+import argparse
+import datetime
+import time
+import json
+import sys
+import os
+
+
+def synthetic_corpus(path, n_pairs, vocabulary_size=50000, zipf_a=1.1,
+                     seed=0):
+    """Write n_pairs synthetic sentence pairs to path
+
+    Tokens follow a Zipf distribution over vocabulary_size words, sentence
+    lengths a log-normal distribution around 20 tokens, like the MSRP
+    corpus. The second sentence of each pair is a noisy copy of the first
+    one, with about a third of its tokens replaced.
+    """
+    rng = np.random.RandomState(seed)
+    ranks = np.arange(1, vocabulary_size + 1, dtype=np.float64)
+    probabilities = ranks ** -zipf_a
+    probabilities /= probabilities.sum()
+    words = np.array([f"w{i}" for i in range(vocabulary_size)])
+    punctuation = np.array(["", "", "", ",", ".", ";", "'s", '"'])
+
+    with open(path, "w") as f:
+        f.write("Quality\t#1 ID\t#2 ID\t#1 String\t#2 String\n")
+        batch = 10000
+        for start in range(0, n_pairs, batch):
+            size = min(batch, n_pairs - start)
+            lengths = np.clip(
+                rng.lognormal(np.log(20), 0.35, size).astype(int), 3, 60)
+            tokens = rng.choice(
+                vocabulary_size, size=lengths.sum(), p=probabilities)
+            noise = rng.choice(
+                vocabulary_size, size=lengths.sum(), p=probabilities)
+            replaced = rng.random_sample(lengths.sum()) < 0.33
+            marks = rng.choice(punctuation, size=lengths.sum())
+            labels = rng.randint(0, 2, size)
+            offset = 0
+            for i, length in enumerate(lengths):
+                t = slice(offset, offset + length)
+                s1 = words[tokens[t]]
+                s2 = np.where(replaced[t], words[noise[t]], s1)
+                offset += length
+                f.write("{}\t{}\t{}\t{}\t{}\n".format(
+                    labels[i], start + i, n_pairs + start + i,
+                    " ".join(s1), " ".join(np.char.add(s2, marks[t]))))
+
+
+@contextlib.contextmanager
+def timed(stages, name):
+    """Add the elapsed wall time of the block to stages[name]"""
+    start = time.perf_counter()
+    yield
+    stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def run_size(n_pairs, work_dir, metric_subset="all", output_format="csv",
+             seed=0):
+    """Run all the preprocessing stages on a corpus of n_pairs"""
+    metrics = _METRIC_SUBSETS_[metric_subset]
+    corpus = os.path.join(work_dir, f"corpus_{n_pairs}.txt")
+    if not os.path.exists(corpus):
+        synthetic_corpus(corpus, n_pairs, seed=seed)
+
+    stages = {}
+    stats = collections.Counter()
+    sentences, y = [], []
+    with timed(stages, "parse"), open(corpus, errors="ignore") as lines:
+        for chunk, labels in read_chunks(lines, 10000, stats):
+            sentences.extend(chunk)
+            y.extend(labels)
+
+    # tokenize is also done by vectorize, timed alone to see its share
+    with timed(stages, "tokenize"):
+        for s1, s2 in sentences:
+            tokenize(s1)
+            tokenize(s2)
+
+    with timed(stages, "vectorize"):
+        left, right, vocabulary = encode_pairs(sentences)
+
+    with timed(stages, "distances"):
+        distances = distance_features(left, right, metrics)
+
+    with timed(stages, "split"):
+        X = np.concatenate((np.array(y).reshape(-1, 1), distances), axis=1)
+        np.random.RandomState(seed).shuffle(X)
+        splits = np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
+
+    # fitted on the train split, like preprocess.py
+    with timed(stages, "scale"):
+        scaling = fit_scaling(splits[0][:, 1:], metrics=metrics)
+        for split in splits:
+            split[:, 1:] = _scale(split[:, 1:], scaling)
+
+    with timed(stages, "impute"):
+        for split in splits:
+            features = split[:, 1:]
+            features[np.isnan(features)] = scaling["fill_value"]
+
+    with timed(stages, "write"):
+        for name, data in zip(("train", "validation", "test"), splits):
+            save_split(data, work_dir, name, output_format)
+
+    return {
+        "n_pairs": n_pairs,
+        "n_tokens": len(vocabulary),
+        "n_features": len(metrics),
+        "malformed_rows": stats["malformed"],
+        "stages": stages,
+        "total": sum(stages.values()),
+        "pairs_per_second": n_pairs / sum(stages.values()),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Stages slower than the baseline run by more than tolerance"""
+    previous = {r["n_pairs"]: r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(result["n_pairs"])
+        if old is None:
+            continue
+        for stage, seconds in result["stages"].items():
+            old_seconds = old["stages"].get(stage)
+            # ignore the noise of very short stages
+            if old_seconds and seconds > 0.01 and \
+                    seconds > old_seconds * (1 + tolerance):
+                regressions.append(
+                    (result["n_pairs"], stage, old_seconds, seconds))
+    return regressions
+
+
+def main(args):
+    # a new process per size, so the peak RSS is not the one of the
+    # largest size seen so far
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        for n_pairs in args.sizes:
+            print(f"Running {n_pairs} pairs ... ", end="", flush=True)
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(
+                    run_size, n_pairs, work_dir, args.metric_subset,
+                    args.output_format, args.seed).result()
+            results.append(result)
+            print("{:.2f}s, {:.0f} pairs/s, peak RSS {:.0f} MB".format(
+                result["total"], result["pairs_per_second"],
+                result["peak_rss_mb"]))
+            for stage, seconds in result["stages"].items():
+                print(f"  {stage:<10} {seconds:9.3f}s")
+
+    outputs = {
+        "created": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "metric_subset": args.metric_subset,
+        "output_format": args.output_format,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(outputs, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for n_pairs, stage, old_seconds, seconds in regressions:
+            print(
+                f"REGRESSION {n_pairs} pairs, {stage}: "
+                f"{old_seconds:.3f}s -> {seconds:.3f}s")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+",
+        default=[1000, 10000, 100000, 1000000],
+        help="number of sentence pairs of each synthetic corpus")
+    parser.add_argument(
+        "--metric-subset", type=str, default="all",
+        choices=sorted(_METRIC_SUBSETS_),
+        help="distance features to compute")
+    parser.add_argument(
+        "--output-format", type=str, default="csv",
+        choices=("csv", "npy", "both"),
+        help="format of the written splits")
+    parser.add_argument(
+        "--output", type=str, default="benchpreprocess_out.json",
+        help="JSON file for the results")
+    parser.add_argument(
+        "--compare", type=str, default=None,
+        help="previous results file to check for regressions")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="allowed slowdown per stage with --compare, 0.2 is 20%%")
+    parser.add_argument(
+        "--work-dir", type=str, default=None,
+        help="keep the corpora and outputs here instead of a temp dir")
+    parser.add_argument("--seed", type=int, default=0)
+
+    main(parser.parse_args())
@@ -0,0 +1,209 @@
+"""Load test the local server of localserve.py
+
+Starts localserve.py in a separate process (or uses a running one with
+--url) and sends it requests from --concurrency client threads, with
+--batch-sizes rows per request. For each combination the throughput and the
+p50/p95/p99 latencies are reported.
+
+python benchserve.py --model-dir model/ --concurrency 1 4 16 \\
+    --batch-sizes 1 10 100
+
+Rows come from a CSV with the label in the first column, like the test.csv
+written by preprocess.py (--data), or are random with --n-features columns.
+Results are written to a JSON file (--output).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import http.client
+import subprocess
+import threading
+import platform
+import argparse
+import datetime
+import socket
+import time
+import json
+import sys
+import io
+import os
+
+import numpy as np
+
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "npy": "application/x-npy",
+    "float32": "application/x-float32",
+}
+
+
+def encode_rows(rows, payload):
+    """Request body of rows in the payload format"""
+    if payload == "csv":
+        return "\n".join(
+            ",".join(repr(float(v)) for v in row) for row in rows
+        ).encode("utf-8")
+    if payload == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, rows.astype(np.float32))
+        return buffer.getvalue()
+    return rows.astype("<f4").tobytes()
+
+
+def load_rows(args):
+    if args.data:
+        # the first column is the label
+        return np.loadtxt(args.data, delimiter=",", ndmin=2)[:, 1:]
+    rng = np.random.RandomState(args.seed)
+    return rng.random_sample((max(args.batch_sizes) * 10, args.n_features))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(model_dir, port, timeout=60):
+    """localserve.py in a new process, returned once /ping answers 200"""
+    process = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(__file__), "localserve.py"),
+        "--model-dir", model_dir, "--port", str(port)])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("localserve.py exited before serving")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/ping")
+            if connection.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"localserve.py not ready after {timeout}s")
+
+
+def run_load(url, bodies, content_type, concurrency, n_requests):
+    """Send n_requests from concurrency threads, one connection each"""
+    target = urlparse(url)
+    local = threading.local()
+    headers = {"Content-Type": content_type, "Accept": "text/csv"}
+
+    def invoke(i):
+        if not hasattr(local, "connection"):
+            local.connection = http.client.HTTPConnection(
+                target.hostname, target.port)
+        start = time.perf_counter()
+        local.connection.request(
+            "POST", "/invocations", bodies[i % len(bodies)], headers)
+        response = local.connection.getresponse()
+        response.read()
+        return time.perf_counter() - start, response.status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(invoke, range(n_requests)))
+    return time.perf_counter() - start, results
+
+
+def summary(elapsed, results, batch_size):
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, status in results if status != 200),
+        "seconds": elapsed,
+        "requests_per_second": len(results) / elapsed,
+        "rows_per_second": len(results) * batch_size / elapsed,
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "max_ms": latencies.max(),
+    }
+
+
+def main(args):
+    rows = load_rows(args)
+    content_type = CONTENT_TYPES[args.payload]
+
+    process = None
+    url = args.url
+    if url is None:
+        if args.model_dir is None:
+            raise SystemExit("Either --url or --model-dir is needed")
+        port = free_port()
+        process = start_server(args.model_dir, port)
+        url = f"http://127.0.0.1:{port}"
+
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            bodies = [
+                encode_rows(rows[i:i + batch_size], args.payload)
+                for i in range(0, len(rows) - batch_size + 1, batch_size)]
+            # warm up the server and the connections
+            run_load(url, bodies, content_type, max(args.concurrency),
+                     max(args.concurrency))
+            for concurrency in args.concurrency:
+                elapsed, responses = run_load(
+                    url, bodies, content_type, concurrency, args.requests)
+                result = dict(
+                    concurrency=concurrency, batch_size=batch_size,
+                    **summary(elapsed, responses, batch_size))
+                results.append(result)
+                print(
+                    "concurrency {concurrency:>3} batch {batch_size:>5}: "
+                    "{requests_per_second:8.1f} req/s {rows_per_second:10.1f} "
+                    "rows/s p50 {p50_ms:7.2f}ms p95 {p95_ms:7.2f}ms "
+                    "p99 {p99_ms:7.2f}ms errors {errors}".format(**result))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    outputs = {
+        "created": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "url": url,
+        "payload": args.payload,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(outputs, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-dir", type=str, default=None,
+        help="start localserve.py with this model directory")
+    parser.add_argument(
+        "--url", type=str, default=None,
+        help="use a running server instead, like http://127.0.0.1:8080")
+    parser.add_argument(
+        "--data", type=str, default=None,
+        help="CSV with the label in the first column, like test.csv")
+    parser.add_argument(
+        "--n-features", type=int, default=23,
+        help="columns of the random rows when --data is not given")
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 4, 16],
+        help="number of client threads")
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[1, 10, 100],
+        help="rows per request")
+    parser.add_argument(
+        "--requests", type=int, default=1000,
+        help="requests sent for each concurrency and batch size")
+    parser.add_argument(
+        "--payload", type=str, default="csv", choices=sorted(CONTENT_TYPES),
+        help="request body format")
+    parser.add_argument(
+        "--output", type=str, default="benchserve_out.json",
+        help="JSON file for the results")
+    parser.add_argument("--seed", type=int, default=0)
+
+    main(parser.parse_args())
@@ -0,0 +1,125 @@
+"""Benchmark the cold start of the model server entry point
+
+Every repeat starts a fresh Python process, imports model_loader.py, loads
+the model with model_fn and serves a first CSV request, timing each step:
+
+import, model_fn, first_request
+
+Two start up modes are compared:
+
+baseline   sagemaker_containers imported eagerly, model.joblib fully
+           unpickled, no warm up (STS_PREDICTOR=sklearn, STS_FAST_START=0)
+fast       the defaults of model_loader.py: deferred imports, model.npz or a
+           memory-mapped model.joblib and a warm up prediction
+
+python benchstartup.py --model-dir model/
+
+The model directory is the one written by training.py (model.joblib and
+optionally model.npz and scaler.json). Results are written to a JSON file
+(--output).
+"""
+import subprocess
+import statistics
+import platform
+import argparse
+import datetime
+import json
+import time
+import sys
+import os
+
+MODES = {
+    "baseline": {"STS_PREDICTOR": "sklearn", "STS_FAST_START": "0"},
+    "fast": {},
+}
+
+
+def child(mode, model_dir):
+    """Time the start up steps in this process, print them as JSON"""
+    timings = {}
+    start = time.perf_counter()
+    if mode == "baseline":
+        # the imports model_loader.py did at module level before
+        from sagemaker_containers.beta.framework import (  # noqa: F401
+            content_types, encoders)
+        import joblib  # noqa: F401
+    import model_loader
+    timings["import"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = model_loader.model_fn(model_dir)
+    timings["model_fn"] = time.perf_counter() - start
+
+    n_features = model_loader._n_features
+    body = ",".join(["0.5"] * n_features)
+    start = time.perf_counter()
+    data = model_loader.input_fn(body, "text/csv")
+    prediction = model_loader.predict_fn(data, model)
+    model_loader.output_fn(prediction, "text/csv")
+    timings["first_request"] = time.perf_counter() - start
+
+    timings["total"] = sum(timings.values())
+    print(json.dumps(timings))
+
+
+def run_mode(mode, model_dir, repeats):
+    """Median of each step over repeats fresh processes"""
+    env = dict(os.environ, **MODES[mode])
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", mode,
+             "--model-dir", model_dir],
+            env=env, check=True, stdout=subprocess.PIPE,
+            universal_newlines=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {step: statistics.median(run[step] for run in runs)
+            for step in runs[0]}
+
+
+def main(args):
+    results = {}
+    for mode in MODES:
+        print(f"Running {mode} x{args.repeats} ... ", end="", flush=True)
+        results[mode] = run_mode(mode, args.model_dir, args.repeats)
+        print("{:.3f}s".format(results[mode]["total"]))
+        for step, seconds in results[mode].items():
+            print(f"  {step:<14} {seconds:8.4f}s")
+
+    baseline, fast = results["baseline"]["total"], results["fast"]["total"]
+    improvement = 1 - fast / baseline
+    print(f"Cold start {baseline:.3f}s -> {fast:.3f}s ({improvement:.0%} less)")
+
+    outputs = {
+        "created": datetime.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "model_dir": os.path.abspath(args.model_dir),
+        "repeats": args.repeats,
+        "results": results,
+        "improvement": improvement,
+    }
+    with open(args.output, "w") as f:
+        json.dump(outputs, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-dir", type=str, required=True,
+        help="directory with model.joblib, like the one of training.py")
+    parser.add_argument(
+        "--repeats", type=int, default=5,
+        help="fresh processes per mode, the median is reported")
+    parser.add_argument(
+        "--output", type=str, default="benchstartup_out.json",
+        help="JSON file for the results")
+    parser.add_argument("--child", type=str, choices=sorted(MODES),
+                        help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.model_dir)
+    else:
+        main(args)
@@ -148,7 +148,9 @@ def main(datacapture=False):
         model_uri,  # s3 uri for the model.tar.gz
         ROLE_ARN,   # sagemaker role to be used
         'model_loader.py',  # script to load the model
-        framework_version='0.23-1'
+        framework_version='0.23-1',
+        # featurization of raw sentence pairs in model_loader.py
+        dependencies=['sts'],
     )
 
     data_capture_config=None
@@ -6,32 +6,56 @@ python gen_fake_ground_truth.py --capture-prefix '2021/02/12/13'
 
 with corresponds to the data capture for day 12 of month 2 of year 2021 for
 the 13 hour,  assuming a hourly interval.
+
+To backfill a range of hours pass the first and the last one instead:
+
+python gen_fake_ground_truth.py --start '2021/02/12/00' --end '2021/02/18/23'
+
+--hour-workers hours are processed at the same time, and the capture files
+of each hour are read by a pool of --workers threads. Only the capture
+files of each hour are listed.
+
+The hours with ground truth are recorded in ground_truth_manifest.json
+under the ground truth S3 Uri, a rerun skips them unless --force is given.
 """
-from sts.utils import load_dataset, get_sm_session
-from sagemaker_containers.beta.framework import content_types, encoders
-from sagemaker.s3 import S3Downloader, S3Uploader
+from sts.utils import load_dataset, get_sm_session, inference_rows
+from sts.capture import decode_capture, split_rows
+from sagemaker.s3 import parse_s3_url
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+import datetime
+import codecs
+import time
 import os
 import argparse
 import json
-import uuid
 import random
 
 
 load_dotenv()
 
+HOUR_FORMAT = "%Y/%m/%d/%H"
+MANIFEST_NAME = "ground_truth_manifest.json"
+
 
 def ground_truth_with_id(
-        inference_id, predicted, labels, inference_id_prefix):
-    """Given a prediction generate ground truth label"""
+        inference_id, rows, predicted, labels):
+    """Given a prediction generate ground truth label
+
+    A request with several rows (see sts.utils.batch_inference_id) gets one
+    label per row, a line each, in the order of the rows.
+    """
     # comment the next line to use the actual label from the inference
     # i am using random here to invalidate some of the values for
     # the quality monitor
-    data_label = random.choice(['1', '0'])
+    data_label = "\n".join(random.choice(['1', '0']) for _ in rows)
 
     # check if original label and predicted are the same and label,
     # uncomment to use test dataset
-    # data_label = '1.0' if label == labels[inference_id-1] else '0.0'
+    # data_label = "\n".join(
+    #     '1.0' if p == labels[row-1] else '0.0'
+    #     for p, row in zip(predicted.ravel(), rows))
 
     return {
         "groundTruthData": {
@@ -39,13 +63,130 @@ def ground_truth_with_id(
             "encoding": "CSV",  # only supports CSV
         }, 
         "eventMetadata": {
-            "eventId": f"{inference_id_prefix}{str(inference_id)}",
+            "eventId": inference_id,
         },
         "eventVersion": "0",
     }
 
 
-def main(deploy_data: dict, train_data: dict, capture_prefix: str):
+def capture_keys(s3_client, capture_uri: str, capture_prefix: str):
+    """Bucket and keys of the capture files of an hour
+
+    Data capture writes the files of an endpoint under
+    <capture_uri>/<variant>/YYYY/MM/DD/HH/, the variants are listed first
+    and then only the keys of the hour in each one.
+    """
+    bucket, prefix = parse_s3_url(capture_uri)
+    prefix = prefix.rstrip("/") + "/"
+    paginator = s3_client.get_paginator("list_objects_v2")
+    variants = [
+        common["Prefix"]
+        for page in paginator.paginate(
+            Bucket=bucket, Prefix=prefix, Delimiter="/")
+        for common in page.get("CommonPrefixes", [])]
+    keys = []
+    for variant in variants:
+        for page in paginator.paginate(
+                Bucket=bucket,
+                Prefix="{}{}/".format(variant, capture_prefix.strip("/"))):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return bucket, sorted(keys)
+
+
+def captured_predictions_of(s3_client, bucket: str, key: str):
+    """Bytes read and (inference id, predictions) of each record of a file
+
+    The lines are read while the file is downloaded and decoded together
+    by sts.capture.decode_capture.
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    columns = decode_capture(
+        codecs.getreader("utf-8")(response["Body"]), inputs=False)
+    predictions = list(zip(columns["inference_id"], split_rows(columns)))
+    return response["ContentLength"], predictions
+
+
+def hours_between(first: str, last: str) -> list:
+    """Capture prefixes YYYY/MM/DD/HH of the hours from first to last"""
+    start = datetime.datetime.strptime(first, HOUR_FORMAT)
+    end = datetime.datetime.strptime(last, HOUR_FORMAT)
+    hours = []
+    while start <= end:
+        hours.append(start.strftime(HOUR_FORMAT))
+        start += datetime.timedelta(hours=1)
+    return hours
+
+
+def read_manifest(s3_client, manifest_uri: str) -> dict:
+    """Hours that already have ground truth, from a previous run"""
+    bucket, key = parse_s3_url(manifest_uri)
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return {"hours": {}}
+        raise
+    return json.loads(body)
+
+
+def write_manifest(s3_client, manifest_uri: str, manifest: dict):
+    bucket, key = parse_s3_url(manifest_uri)
+    s3_client.put_object(
+        Bucket=bucket, Key=key,
+        Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+
+
+def ground_truth_for_hour(
+        s3_client, files_executor, capture_uri: str, ground_truth_uri: str,
+        capture_prefix: str, Y_val, inference_id_prefix: str) -> dict:
+    """Read the captures of an hour and upload their ground truth
+
+    Returns a summary of the hour, with the S3 Uri of the ground truth
+    file, None when the hour has no captures.
+    """
+    start = time.perf_counter()
+    bucket, keys = capture_keys(s3_client, capture_uri, capture_prefix)
+
+    captured_predictions = {}
+    n_records = n_bytes = 0
+    files = files_executor.map(
+        lambda key: captured_predictions_of(s3_client, bucket, key), keys)
+    for size, predictions in files:
+        n_bytes += size
+        n_records += len(predictions)
+        for inference_id, Y_pred_value in predictions:
+            # rows of test.csv in the request, starting in 1, see
+            # sts.utils.batch_inference_id
+            rows = inference_rows(inference_id, inference_id_prefix)
+            captured_predictions[inference_id] = (rows, Y_pred_value)
+
+    target_s3_uri = None
+    if captured_predictions:
+        # save and upload the ground truth labels, the same file name on
+        # every run so a rerun replaces it
+        fake_records = []
+        for i, (rows, label) in captured_predictions.items():
+            val = ground_truth_with_id(i, rows, label, Y_val)
+            fake_records.append(json.dumps(val))
+
+        target_s3_uri = "{}/{}/ground_truth.jsonl".format(
+            ground_truth_uri, capture_prefix)
+        target_bucket, target_key = parse_s3_url(target_s3_uri)
+        s3_client.put_object(
+            Bucket=target_bucket, Key=target_key,
+            Body="\n".join(fake_records).encode("utf-8"))
+
+    return {
+        "capture_files": len(keys),
+        "records": n_records,
+        "bytes": n_bytes,
+        "seconds": time.perf_counter() - start,
+        "ground_truth": target_s3_uri,
+    }
+
+
+def main(deploy_data: dict, train_data: dict, hours: list,
+         workers: int = 8, hour_workers: int = 4, force: bool = False):
     inference_id_prefix = 'sts_'  # the same used in testendpoint.py
 
     # Load config from environment and set required defaults
@@ -61,73 +202,59 @@ def main(deploy_data: dict, train_data: dict, capture_prefix: str):
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY
     )
 
-    # read test data
+    # read test data, once for all the hours
     test_data = load_dataset(
         train_data['train']['test'], 'test.csv', sagemaker_session=sm_session)
     print(f"Loadding {train_data['train']['test']}")
     Y_val = test_data.iloc[:, 0].to_numpy()
     print(f"Test dataset shape: {Y_val.shape}")
 
-    # list capture files, this is just as an example. Not used right
-    # now but could be.
-    capture_files = sorted(
-        S3Downloader.list(
-            "{}/{}".format(
-                deploy_data['monitor']['s3_capture_upload_path'],
-                deploy_data['endpoint']['name']),
-            sagemaker_session=sm_session)
-    )
-    # just the files with the prefix
-    filtered = list(filter(
-        lambda file_name: capture_prefix in file_name, capture_files))
-    print(f"Detected {len(filtered)} capture files")
+    s3_client = b3_session.client('s3')
+    capture_uri = "{}/{}".format(
+        deploy_data['monitor']['s3_capture_upload_path'],
+        deploy_data['endpoint']['name'])
+    ground_truth_uri = deploy_data['monitor']['ground truth uri']
+    manifest_uri = f"{ground_truth_uri}/{MANIFEST_NAME}"
 
-    capture_records = []
-    for c_file in filtered:
-        print(f"Processing: {c_file}")
-        # read the capture data directly from S3
-        content = S3Downloader.read_file(c_file, sagemaker_session=sm_session)
-        records = [json.loads(l) for l in content.split("\n")[:-1]]
+    # hours with ground truth from a previous run are skipped
+    manifest = read_manifest(s3_client, manifest_uri)
+    pending = [
+        hour for hour in hours if force or hour not in manifest["hours"]]
+    print(f"{len(hours) - len(pending)} of {len(hours)} hours already have "
+          f"ground truth, see {manifest_uri}")
 
-        capture_records.extend(records)
-
-    print(f"No. of records {len(capture_records)} captured")
-    captured_predictions = {}
+    n_records = n_bytes = 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(workers) as files_executor, \
+                ThreadPoolExecutor(hour_workers) as hours_executor:
+            futures = {
+                hours_executor.submit(
+                    ground_truth_for_hour, s3_client, files_executor,
+                    capture_uri, ground_truth_uri, hour, Y_val,
+                    inference_id_prefix): hour
+                for hour in pending}
+            for future in as_completed(futures):
+                hour, summary = futures[future], future.result()
+                n_records += summary["records"]
+                n_bytes += summary["bytes"]
+                if summary["ground_truth"] is None:
+                    # captures may still arrive, try again on the next run
+                    print(f"{hour}: no capture files")
+                    continue
+                manifest["hours"][hour] = summary
+                print(
+                    f"{hour}: {summary['capture_files']} capture files, "
+                    f"{summary['records']} records, ground truth uploaded "
+                    f"to {summary['ground_truth']}")
+    finally:
+        write_manifest(s3_client, manifest_uri, manifest)
 
-    for obj in capture_records:
-        # Extract inference ID
-        inference_id = obj["eventMetadata"]["inferenceId"]
-        # current version of script start in 1 when id=0
-        # remove the prefix and get the id
-        req_id = int(inference_id[len(inference_id_prefix):])
-        
-        # Extract result given by the model
-        Y_pred_value = encoders.decode(
-            obj["captureData"]["endpointOutput"]["data"],
-            # i have fixed this value here becouse 
-            # obj["captureData"]["endpointOutput"]["observedContentType"]
-            # some times include the encoding like: text/csv; utf-8
-            # and encoders.decode() will give error.
-            content_types.CSV)
-        captured_predictions[req_id] = Y_pred_value  # np.array
-
-
-    # save and upload the ground truth labels
-    print("Generating labels")
-    fake_records = []
-    for i,label in captured_predictions.items():
-        val = ground_truth_with_id(i,label, Y_val, inference_id_prefix)
-        fake_records.append(json.dumps(val))
-
-    data_to_upload = "\n".join(fake_records)
-    target_s3_uri = "{}/{}/{}.jsonl".format(
-        deploy_data['monitor']['ground truth uri'],
-        capture_prefix,
-        uuid.uuid4().hex)
-    print(f"Uploading ground truth to {target_s3_uri} ...", end="")
-    S3Uploader.upload_string_as_file_body(
-        data_to_upload, target_s3_uri, sagemaker_session=sm_session)
-    print("Done !")
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"No. of records {n_records} captured")
+    print("Read {:.2f} MB in {:.1f}s, {:.2f} MB/s, {:.0f} records/s".format(
+        n_bytes / 2**20, elapsed, n_bytes / 2**20 / elapsed,
+        n_records / elapsed))
 
 
 if __name__ == '__main__':
@@ -143,11 +270,37 @@ if __name__ == '__main__':
         help="JSON output from the train script"
     )
     parser.add_argument(
-        "--capture-prefix", type=str, required=True, 
+        "--capture-prefix", type=str, required=False, 
         help="Capture data prefix in the format YYYY/MM/DD/HH"
     )
+    parser.add_argument(
+        "--start", type=str, required=False,
+        help="first hour of a range, in the format YYYY/MM/DD/HH"
+    )
+    parser.add_argument(
+        "--end", type=str, required=False,
+        help="last hour of a range, in the format YYYY/MM/DD/HH"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8,
+        help="capture files read at the same time"
+    )
+    parser.add_argument(
+        "--hour-workers", type=int, default=4,
+        help="hours processed at the same time"
+    )
+    parser.add_argument(
+        "--force", action='store_true',
+        help="generate again the hours that already have ground truth"
+    )
 
     args, _ = parser.parse_known_args()
+    if args.capture_prefix:
+        hours = [args.capture_prefix.strip("/")]
+    elif args.start and args.end:
+        hours = hours_between(args.start, args.end)
+    else:
+        parser.error("--capture-prefix or --start and --end are required")
     print(f"Using deploy info {args.deploymodel_output}")
     print(f"Using training info {args.trainmodel_output}")
     with open(args.deploymodel_output) as f:
@@ -156,4 +309,5 @@ if __name__ == '__main__':
     with open(args.trainmodel_output) as f:
         train_data = json.load(f)
 
-    main(deploy_data, train_data, args.capture_prefix)
+    main(deploy_data, train_data, hours, args.workers, args.hour_workers,
+         args.force)
@@ -0,0 +1,253 @@
+"""Model quality monitor, run locally and incrementally
+
+Computes the regression metrics of the SageMaker model quality monitor
+(mse, rmse, mae and r2) per hour from local copies of the data capture and
+the ground truth, in the layout written by the endpoint and
+gen_fake_ground_truth.py: .jsonl files under YYYY/MM/DD/HH directories. For
+example, after
+
+aws s3 sync <s3_capture_upload_path>/<endpoint name> captures/
+aws s3 sync "<ground truth uri>" ground_truth/
+
+python localmonitor.py --capture-dir captures/ \\
+    --ground-truth-dir ground_truth/ --constraints constraints.json
+
+The ground truth of an hour (and of the next --ground-truth-lag hours) is
+loaded in a hash index by eventId, the capture files of the hour are then
+streamed and joined on their inferenceId. Only the hours not in the state
+file (--state) are processed, the running aggregates of the previous hours
+are read from it instead of the data. constraints.json is the one suggested
+by the baselining job of setupmq.py, each hour and the total are compared
+against it.
+"""
+from sts.capture import decode_capture, split_rows
+import numpy as np
+import datetime
+import argparse
+import json
+import math
+import re
+import os
+
+HOUR_FORMAT = "%Y/%m/%d/%H"
+_HOUR_PATTERN_ = re.compile(r"(\d{4})/(\d{2})/(\d{2})/(\d{2})$")
+
+# how each comparison_operator of the constraints is violated
+_VIOLATIONS_ = {
+    "GreaterThanThreshold": lambda value, threshold: value > threshold,
+    "GreaterThanOrEqualToThreshold": lambda value, threshold:
+        value >= threshold,
+    "LessThanThreshold": lambda value, threshold: value < threshold,
+    "LessThanOrEqualToThreshold": lambda value, threshold:
+        value <= threshold,
+}
+
+
+def hour_files(root):
+    """.jsonl files under root, by their YYYY/MM/DD/HH directory"""
+    hours = {}
+    for directory, _, names in os.walk(root):
+        match = _HOUR_PATTERN_.search(directory.replace(os.sep, "/"))
+        files = sorted(name for name in names if name.endswith(".jsonl"))
+        if match and files:
+            hours.setdefault("/".join(match.groups()), []).extend(
+                os.path.join(directory, name) for name in files)
+    return hours
+
+
+def later_hours(hour, n):
+    """hour and the n hours after it"""
+    start = datetime.datetime.strptime(hour, HOUR_FORMAT)
+    return [
+        (start + datetime.timedelta(hours=i)).strftime(HOUR_FORMAT)
+        for i in range(n + 1)]
+
+
+def ground_truth_index(paths):
+    """Labels of the ground truth records by eventId"""
+    index = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                data = record["groundTruthData"]["data"]
+                index[record["eventMetadata"]["eventId"]] = np.fromstring(
+                    data.strip().replace("\n", ","), dtype=np.float64,
+                    sep=",")
+    return index
+
+
+class RunningMetrics:
+    """Sums from which the regression metrics of any number of rows follow
+
+    Adding the sums of two sets of rows gives the ones of all of them, so
+    past hours never need to be read again.
+    """
+
+    _FIELDS_ = ("n", "sum_squared_error", "sum_absolute_error",
+                "sum_label", "sum_squared_label")
+
+    def __init__(self, n=0, sum_squared_error=0.0, sum_absolute_error=0.0,
+                 sum_label=0.0, sum_squared_label=0.0):
+        self.n = n
+        self.sum_squared_error = sum_squared_error
+        self.sum_absolute_error = sum_absolute_error
+        self.sum_label = sum_label
+        self.sum_squared_label = sum_squared_label
+
+    def update(self, labels, predictions):
+        errors = predictions - labels
+        self.n += len(labels)
+        self.sum_squared_error += float(np.dot(errors, errors))
+        self.sum_absolute_error += float(np.abs(errors).sum())
+        self.sum_label += float(labels.sum())
+        self.sum_squared_label += float(np.dot(labels, labels))
+
+    def merge(self, other):
+        for field in self._FIELDS_:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self._FIELDS_}
+
+    def metrics(self):
+        """mse, rmse, mae and r2, None without rows (r2 without variance)"""
+        if not self.n:
+            return {"mse": None, "rmse": None, "mae": None, "r2": None}
+        mse = self.sum_squared_error / self.n
+        total = self.sum_squared_label - self.sum_label ** 2 / self.n
+        return {
+            "mse": mse,
+            "rmse": math.sqrt(mse),
+            "mae": self.sum_absolute_error / self.n,
+            "r2": 1 - self.sum_squared_error / total if total > 0 else None,
+        }
+
+
+def check_constraints(metrics, constraints):
+    """Violations of the regression_constraints of a baselining job"""
+    violations = []
+    for name, constraint in constraints.get(
+            "regression_constraints", {}).items():
+        value = metrics.get(name)
+        violated = _VIOLATIONS_[constraint["comparison_operator"]]
+        if value is not None and violated(value, constraint["threshold"]):
+            violations.append({
+                "metric": name,
+                "value": value,
+                "threshold": constraint["threshold"],
+                "comparison_operator": constraint["comparison_operator"],
+            })
+    return violations
+
+
+def monitor_hour(capture_paths, index, stats):
+    """Metrics of the capture files of an hour joined with the index
+
+    The files are decoded one at a time, the joined rows go directly to the
+    running sums. stats counts the matched and unmatched records.
+    """
+    metrics = RunningMetrics()
+    for path in capture_paths:
+        with open(path) as f:
+            columns = decode_capture(f, inputs=False)
+        labels, predictions = [], []
+        for inference_id, predicted in zip(
+                columns["inference_id"], split_rows(columns)):
+            label = index.get(inference_id)
+            if label is None or len(label) != len(predicted):
+                stats["unmatched"] += 1
+                continue
+            stats["matched"] += 1
+            labels.append(label)
+            predictions.append(predicted)
+        if labels:
+            metrics.update(
+                np.concatenate(labels), np.concatenate(predictions))
+    return metrics
+
+
+def save_state(path, state):
+    """Write the state file through a temporary file"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def format_metrics(metrics):
+    return ", ".join(
+        "{} {}".format(name, "-" if value is None else f"{value:.4f}")
+        for name, value in metrics.items())
+
+
+def main(args):
+    state = {"hours": {}, "total": RunningMetrics().to_dict()}
+    if os.path.exists(args.state):
+        with open(args.state) as f:
+            state = json.load(f)
+    constraints = {}
+    if args.constraints:
+        with open(args.constraints) as f:
+            constraints = json.load(f)
+
+    captures = hour_files(args.capture_dir)
+    ground_truth = hour_files(args.ground_truth_dir)
+    pending = sorted(hour for hour in captures if hour not in state["hours"])
+    print(f"{len(captures)} hours of captures, {len(pending)} not monitored "
+          f"yet, see {args.state}")
+
+    total = RunningMetrics(**state["total"])
+    for hour in pending:
+        index = ground_truth_index([
+            path for gt_hour in later_hours(hour, args.ground_truth_lag)
+            for path in ground_truth.get(gt_hour, [])])
+        stats = {"matched": 0, "unmatched": 0}
+        metrics = monitor_hour(captures[hour], index, stats)
+        if not metrics.n:
+            # the ground truth may still arrive, try again on the next run
+            print(f"{hour}: no ground truth for {stats['unmatched']} records")
+            continue
+        total.merge(metrics)
+        hour_metrics = metrics.metrics()
+        violations = check_constraints(hour_metrics, constraints)
+        state["hours"][hour] = dict(
+            stats, rows=metrics.n, sums=metrics.to_dict(),
+            metrics=hour_metrics, violations=violations,
+            cumulative=total.metrics())
+        state["total"] = total.to_dict()
+        save_state(args.state, state)
+        print("{}: {} rows, {}{}".format(
+            hour, metrics.n, format_metrics(hour_metrics),
+            "".join(
+                "\n  VIOLATION {metric} {value:.4f} {comparison_operator} "
+                "{threshold}".format(**v) for v in violations)))
+
+    total_metrics = total.metrics()
+    print(f"Total: {total.n} rows, {format_metrics(total_metrics)}")
+    for v in check_constraints(total_metrics, constraints):
+        print("  VIOLATION {metric} {value:.4f} {comparison_operator} "
+              "{threshold}".format(**v))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--capture-dir", type=str, required=True,
+        help="local copy of the data capture of the endpoint")
+    parser.add_argument(
+        "--ground-truth-dir", type=str, required=True,
+        help="local copy of the ground truth uri")
+    parser.add_argument(
+        "--constraints", type=str, default=None,
+        help="constraints.json of the baselining job")
+    parser.add_argument(
+        "--state", type=str, default="localmonitor_state.json",
+        help="JSON file with the results and running sums of past hours")
+    parser.add_argument(
+        "--ground-truth-lag", type=int, default=0,
+        help="also join with the ground truth of this many later hours")
+
+    main(parser.parse_args())
@@ -0,0 +1,145 @@
+"""Serve model_loader.py locally, like a SageMaker endpoint
+
+Implements the SageMaker inference contract on top of model_fn, input_fn,
+predict_fn and output_fn of model_loader.py:
+
+GET /ping           200 once the model is loaded
+POST /invocations   request body decoded with the Content-Type header and
+                    the predictions encoded with the Accept header
+
+Like the SageMaker scikit-learn container, text/csv and application/json
+bodies are given to input_fn as text, an unsupported Content-Type is
+answered with 415 and an unsupported Accept with 406.
+
+python localserve.py --model-dir model/ --port 8080
+
+Everything runs offline, the model directory is the one written by
+training.py (model.joblib and optionally model.npz and scaler.json).
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import model_loader
+import argparse
+import logging
+import json
+import os
+
+_l = logging.getLogger(__name__)
+
+# the same as sagemaker_containers content_types.UTF8_TYPES
+UTF8_TYPES = ("application/json", "text/csv")
+
+DEFAULT_ACCEPT = os.getenv(
+    "SAGEMAKER_DEFAULT_INVOCATIONS_ACCEPT", "application/json")
+
+
+def transform(model, body, content_type, accept):
+    """(status, body, content type) of an invocation, like the container"""
+    from sagemaker_containers.beta.framework import errors
+
+    if content_type in UTF8_TYPES:
+        body = body.decode("utf-8")
+    try:
+        data = model_loader.input_fn(body, content_type)
+    except errors.UnsupportedFormatError as e:
+        return 415, error_body(e), "application/json"
+
+    prediction = model_loader.predict_fn(data, model)
+
+    try:
+        response, response_type = model_loader.output_fn(prediction, accept)
+    except errors.UnsupportedFormatError as e:
+        return 406, error_body(e), "application/json"
+    if isinstance(response, str):
+        response = response.encode("utf-8")
+    return 200, response, response_type
+
+
+def error_body(error):
+    return json.dumps({
+        "error": error.__class__.__name__,
+        "error-message": str(error),
+    }).encode("utf-8")
+
+
+class InvocationsHandler(BaseHTTPRequestHandler):
+    """/ping and /invocations of the model loaded in self.server.model"""
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not wait for the ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != "/ping":
+            self.reply(404, b"", "text/plain")
+        elif self.server.model is None:
+            self.reply(503, b"", "text/plain")
+        else:
+            self.reply(200, b"", "text/plain")
+
+    def do_POST(self):
+        if self.path != "/invocations":
+            self.reply(404, b"", "text/plain")
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type = self.headers.get("ContentType") or \
+            self.headers.get("Content-Type") or "application/json"
+        accept = self.headers.get("Accept")
+        if not accept or accept == "*/*":
+            accept = DEFAULT_ACCEPT
+        try:
+            status, response, response_type = transform(
+                self.server.model, body, content_type, accept)
+        except Exception as e:
+            _l.exception("Invocation failed")
+            status, response, response_type = \
+                500, error_body(e), "application/json"
+        self.reply(status, response, response_type)
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _l.debug(format, *args)
+
+
+class InferenceServer(ThreadingMixIn, HTTPServer):
+    """One thread per connection, like the workers of the container"""
+
+    daemon_threads = True
+    # the default of 5 resets connections under concurrent load
+    request_queue_size = 128
+
+    def __init__(self, address, model_dir):
+        self.model = None
+        super().__init__(address, InvocationsHandler)
+        self.model = model_loader.model_fn(model_dir)
+
+
+def main(args):
+    server = InferenceServer((args.host, args.port), args.model_dir)
+    _l.info("Serving %s on http://%s:%d",
+            args.model_dir, *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-dir", type=str, required=True,
+        help="directory with model.joblib, like the one of training.py")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+
+    main(parser.parse_args())
@@ -1,17 +1,346 @@
-"""This will be used as an entry point when serving the model"""
-from sagemaker_containers.beta.framework import content_types, encoders
+"""This will be used as an entry point when serving the model
+
+sagemaker_containers, joblib and sklearn are imported only when a request or
+the model needs them, to keep the start up of new instances short.
+"""
 import numpy as np
-import joblib
+from concurrent.futures import Future
+import collections
+import threading
+import queue
+import hashlib
+import logging
+import time
+import json
+import io
 import os
 
+_l = logging.getLogger(__name__)
+
+# raw sentence pairs, JSON encoded: ["sentence 1", "sentence 2"] for a single
+# pair, [["sentence 1", "sentence 2"], ...] or {"pairs": [...]} for a batch
+SENTENCE_PAIRS = "application/x-sentence-pairs+json"
+
+# raw little-endian float32 values, row after row, without any header
+RAW_FLOAT32 = "application/x-float32"
+
+# the same as sagemaker_containers content_types.NPY
+NPY = "application/x-npy"
+
+# scaling parameters saved by preprocess.py, loaded by model_fn
+_scaling = None
+# number of features expected by the model, to shape RAW_FLOAT32 payloads
+_n_features = None
+
+# "compiled" serves model.npz with NumPy when present, "sklearn" model.joblib
+PREDICTOR = os.getenv("STS_PREDICTOR", "compiled")
+
+# memory-map model.joblib and run a dummy prediction when loading the model
+FAST_START = os.getenv("STS_FAST_START", "1") == "1"
+
+# rows kept by the prediction cache, 0 disables it
+PREDICTION_CACHE_SIZE = int(os.getenv("STS_PREDICTION_CACHE_SIZE", "0"))
+# log the prediction cache stats every this many requests
+PREDICTION_CACHE_LOG_EVERY = int(
+    os.getenv("STS_PREDICTION_CACHE_LOG_EVERY", "1000"))
+
+# milliseconds to wait for more requests to predict together, 0 disables it
+BATCH_WINDOW_MS = float(os.getenv("STS_BATCH_WINDOW_MS", "0"))
+# rows of a coalesced batch, more requests wait for the next one
+BATCH_MAX_SIZE = int(os.getenv("STS_BATCH_MAX_SIZE", "64"))
+# log the micro-batching stats every this many batches
+BATCH_LOG_EVERY = int(os.getenv("STS_BATCH_LOG_EVERY", "1000"))
+
+
+class PredictionCache:
+    """Bounded LRU cache of the predictions of single rows
+
+    Rows are identified by a hash of their dtype and bytes. Only the rows of
+    a batch missing from the cache are sent to the model.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._rows = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.requests = 0
+
+    @staticmethod
+    def _key(row):
+        data = row.dtype.str.encode() + np.ascontiguousarray(row).tobytes()
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def predict(self, model, X):
+        """model.predict(X), with the cached rows not predicted again"""
+        keys = [self._key(row) for row in X]
+        results = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._rows:
+                    self._rows.move_to_end(key)
+                    results[i] = self._rows[key]
+            missing = [i for i, r in enumerate(results) if r is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+            self.requests += 1
+
+        if missing:
+            predicted = model.predict(X[missing])
+            with self._lock:
+                for i, prediction in zip(missing, predicted):
+                    results[i] = prediction
+                    self._rows[keys[i]] = prediction
+                    self._rows.move_to_end(keys[i])
+                while len(self._rows) > self.capacity:
+                    self._rows.popitem(last=False)
+                    self.evictions += 1
+
+        if PREDICTION_CACHE_LOG_EVERY and \
+                self.requests % PREDICTION_CACHE_LOG_EVERY == 0:
+            _l.info("Prediction cache: %s", self.stats())
+        return np.asarray(results)
+
+    def stats(self):
+        """Counters of the cache, hit_rate is over all the rows seen"""
+        rows = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / rows if rows else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# created by model_fn when PREDICTION_CACHE_SIZE > 0
+_prediction_cache = None
+
+
+def prediction_cache_stats():
+    """Stats of the prediction cache, None if it is disabled"""
+    return _prediction_cache.stats() if _prediction_cache else None
+
+
+class MicroBatcher:
+    """Coalesce the rows of concurrent requests into one prediction
+
+    Each predict call queues its rows and waits. A single thread takes the
+    first queued request, gathers the ones that arrive within window
+    seconds of it, up to max_size rows, predicts them with one call and
+    gives every caller its own rows back. A request that would go over
+    max_size starts the next batch, only a request larger than max_size
+    makes a larger batch, alone. A request waits at most the window plus
+    the prediction of its batch, or of two batches when it is carried over.
+    """
+
+    def __init__(self, predict, window, max_size, history=10000):
+        self.window = window
+        self.max_size = max_size
+        self._predict = predict
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # batch sizes and queue waits of the latest batches, for the stats
+        self._sizes = collections.deque(maxlen=history)
+        self._waits = collections.deque(maxlen=history)
+        self.requests = self.batches = self.rows = 0
+        threading.Thread(
+            target=self._run, name="micro-batcher", daemon=True).start()
+
+    def predict(self, X):
+        """Predictions of the rows of X, predicted along with other requests"""
+        future = Future()
+        self._queue.put((X, future, time.perf_counter()))
+        return future.result()
+
+    def _run(self):
+        carried = None
+        while True:
+            # a request that did not fit in the previous batch starts this one
+            batch = [carried or self._queue.get()]
+            carried = None
+            rows = len(batch[0][0])
+            deadline = batch[0][2] + self.window
+            while rows < self.max_size:
+                # after the window only take what is already queued
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = (
+                        self._queue.get(timeout=timeout) if timeout > 0
+                        else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                if rows + len(request[0]) > self.max_size:
+                    carried = request
+                    break
+                batch.append(request)
+                rows += len(request[0])
+            self._predict_batch(batch, rows)
+
+    def _predict_batch(self, batch, rows):
+        started = time.perf_counter()
+        try:
+            predictions = self._predict(
+                np.concatenate([X for X, _, _ in batch]))
+        except Exception:
+            # predict alone, so one bad request does not fail the others
+            for X, future, _ in batch:
+                try:
+                    future.set_result(self._predict(X))
+                except Exception as e:
+                    future.set_exception(e)
+        else:
+            offsets = np.cumsum([len(X) for X, _, _ in batch])[:-1]
+            for (_, future, _), result in zip(
+                    batch, np.split(predictions, offsets)):
+                future.set_result(result)
+
+        with self._lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.rows += rows
+            self._sizes.append(rows)
+            self._waits.extend(started - enqueued for _, _, enqueued in batch)
+        if BATCH_LOG_EVERY and self.batches % BATCH_LOG_EVERY == 0:
+            _l.info("Micro-batching: %s", self.stats())
+
+    def stats(self):
+        """Counters, and batch sizes and queue waits of the latest batches"""
+        with self._lock:
+            sizes = np.array(self._sizes)
+            waits = np.array(self._waits) * 1000
+        stats = {
+            "requests": self.requests,
+            "batches": self.batches,
+            "rows": self.rows,
+        }
+        if len(sizes):
+            stats.update({
+                "batch_size_mean": float(sizes.mean()),
+                "batch_size_max": int(sizes.max()),
+                "queue_wait_ms_p50": float(np.percentile(waits, 50)),
+                "queue_wait_ms_p99": float(np.percentile(waits, 99)),
+                "queue_wait_ms_max": float(waits.max()),
+            })
+        return stats
+
+
+# created by model_fn when BATCH_WINDOW_MS > 0
+_batcher = None
+
+
+def batching_stats():
+    """Stats of the micro-batching, None if it is disabled"""
+    return _batcher.stats() if _batcher else None
+
+
+def _framework():
+    """content_types and encoders of sagemaker_containers, imported on use"""
+    from sagemaker_containers.beta.framework import content_types, encoders
+    return content_types, encoders
+
+
+def warm_up(model):
+    """Run one dummy prediction, so the first request does not pay for it"""
+    n_features = _n_features or getattr(model, "n_features_in_", None)
+    if n_features is None:
+        return
+    start = time.perf_counter()
+    model.predict(np.zeros((1, n_features), dtype=np.float32))
+    _l.info("Warm up prediction in %.4fs", time.perf_counter() - start)
+
+
 def model_fn(model_dir):
     """Deserialized and return fitted model
     Note that this should have the same name as the serialized model in the main method
     """
-    clf = joblib.load(os.path.join(model_dir, "model.joblib"))
+    global _scaling, _n_features, _prediction_cache, _batcher
+    compiled_path = os.path.join(model_dir, "model.npz")
+    if PREDICTOR == "compiled" and os.path.exists(compiled_path):
+        from sts.compiled import LinearPredictor
+        clf = LinearPredictor.load(compiled_path)
+    else:
+        import joblib
+        # the arrays of an uncompressed joblib file can be memory-mapped
+        clf = joblib.load(
+            os.path.join(model_dir, "model.joblib"),
+            mmap_mode="r" if FAST_START else None)
+    if hasattr(clf, "coef_"):
+        _n_features = np.shape(clf.coef_)[-1]
+
+    # only present for models trained with the scaling parameters
+    scaler_path = os.path.join(model_dir, "scaler.json")
+    if os.path.exists(scaler_path):
+        with open(scaler_path) as f:
+            _scaling = json.load(f)
+
+    if PREDICTION_CACHE_SIZE > 0:
+        _prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE)
+    if BATCH_WINDOW_MS > 0:
+        _batcher = MicroBatcher(
+            clf.predict, BATCH_WINDOW_MS / 1000, BATCH_MAX_SIZE)
+    if FAST_START:
+        warm_up(clf)
     return clf
 
 
+def decode_pairs(input_data):
+    """List of (sentence 1, sentence 2) tuples from a SENTENCE_PAIRS body"""
+    if isinstance(input_data, bytes):
+        input_data = input_data.decode("utf-8")
+    pairs = json.loads(input_data)
+    if isinstance(pairs, dict):
+        pairs = pairs["pairs"]
+    if len(pairs) == 2 and all(isinstance(s, str) for s in pairs):
+        pairs = [pairs]
+    for pair in pairs:
+        if len(pair) != 2 or not all(isinstance(s, str) for s in pair):
+            raise ValueError(f"Not a sentence pair: {pair}")
+    return [tuple(pair) for pair in pairs]
+
+
+def featurize_pairs(pairs):
+    """Scaled distance features of sentence pairs, the same as preprocess.py"""
+    # needs the sts package deployed with the entry point
+    from sts.preprocess import _VALID_METRICS_, featurize, scale_features
+
+    if _scaling is None:
+        raise ValueError(
+            "The model has no scaler.json, sentence pairs are not supported")
+    metrics = _scaling.get("metrics") or _VALID_METRICS_
+    features = scale_features(featurize(pairs, metrics), _scaling)
+    return features.astype(np.float32)
+
+
+def _media_type(content_type):
+    """Content type without its parameters, like charset"""
+    return content_type.split(";")[0].strip()
+
+
+def decode_npy(input_data):
+    """Array view of a .npy payload, the data is not copied"""
+    f = io.BytesIO(input_data)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    array = np.frombuffer(
+        input_data, dtype=dtype, count=int(np.prod(shape)), offset=f.tell())
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def decode_float32(input_data):
+    """Array view of a RAW_FLOAT32 payload, one row per model input"""
+    array = np.frombuffer(input_data, dtype="<f4")
+    if _n_features is None:
+        return array.reshape(1, -1)
+    if array.size % _n_features:
+        raise ValueError(
+            f"{array.size} values are not rows of {_n_features} features")
+    return array.reshape(-1, _n_features)
+
+
 def input_fn(input_data, content_type):
     """Takes request data and de-serializes the data into an object for prediction.
         When an InvokeEndpoint operation is made against an Endpoint running SageMaker model server,
@@ -19,12 +348,22 @@ def input_fn(input_data, content_type):
             - The request Content-Type, for example "application/json"
             - The request data, which is at most 5 MB (5 * 1024 * 1024 bytes) in size.
         The input_fn is responsible to take the request data and pre-process it before prediction.
+        With SENTENCE_PAIRS as content type the features are computed here.
     Args:
         input_data (obj): the request data.
         content_type (str): the request Content-Type.
     Returns:
         (obj): data ready for prediction.
     """
+    media_type = _media_type(content_type)
+    if media_type == SENTENCE_PAIRS:
+        return featurize_pairs(decode_pairs(input_data))
+    if media_type == NPY:
+        return np.atleast_2d(decode_npy(input_data))
+    if media_type == RAW_FLOAT32:
+        return decode_float32(input_data)
+
+    content_types, encoders = _framework()
     np_array = encoders.decode(input_data, content_type)
     ret = np_array.astype(np.float32) if content_type in content_types.UTF8_TYPES else np_array
     # reshaping if contains a single sample, necesary if when using CSV as
@@ -34,3 +373,34 @@ def input_fn(input_data, content_type):
         ret = ret.reshape(1,-1)
 
     return ret
+
+
+def predict_fn(input_data, model):
+    """One vectorized prediction for all the rows of the request
+
+    With the prediction cache enabled only the rows not seen recently are
+    predicted, with micro-batching they are predicted along with the rows
+    of other concurrent requests.
+    """
+    predictor = _batcher or model
+    if _prediction_cache is not None:
+        return _prediction_cache.predict(predictor, input_data)
+    return predictor.predict(input_data)
+
+
+def output_fn(prediction, accept):
+    """Serialize the predictions, NPY and RAW_FLOAT32 without text encoding
+
+    Returns:
+        (bytes, content type) tuple
+    """
+    media_type = _media_type(accept)
+    if media_type == NPY:
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(prediction))
+        return buffer.getvalue(), accept
+    if media_type == RAW_FLOAT32:
+        return np.asarray(prediction, dtype="<f4").tobytes(), accept
+
+    _, encoders = _framework()
+    return encoders.encode(prediction, accept), accept
@@ -1,4 +1,6 @@
 "Baseline script for model quality monitoring"""
+import os
+import sys
 import logging
 import pathlib
 import pickle
@@ -8,10 +10,15 @@ import joblib
 import numpy as np
 import pandas as pd
 
+# splits.py is given to the processing job as an input, see pipeline.py
+sys.path.append("/opt/ml/processing/splits")
+from splits import load_split
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+
 if __name__ == "__main__":
     logger.info("Setup model quality baline dataset")
 
@@ -31,14 +38,12 @@ if __name__ == "__main__":
     output_dir = "/opt/ml/processing/validate"
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    data_path = "/opt/ml/processing/validation/validation.csv"
-    validate_set_df = pd.read_csv(data_path, header=None)
-    logger.info(validate_set_df.describe())
+    validate_set = load_split("/opt/ml/processing/validation", "validation")
+    logger.info(pd.DataFrame(validate_set).describe())
 
     # labels this is of type pandas.core.series.Series
-    y_test = validate_set_df.iloc[:, 0]
-    validate_set_df.drop(validate_set_df.columns[0], axis=1, inplace=True)
-    topredict = validate_set_df.values
+    y_test = pd.Series(validate_set[:, 0])
+    topredict = np.asarray(validate_set[:, 1:])
 
     # predictions is numpy.ndarray
     logger.info("Performing predictions against test data.")
@@ -0,0 +1,150 @@
+"""Columnar decoding of SageMaker data capture files
+
+A data capture file has a JSON line per request made to the endpoint, with
+the request and response payloads in captureData and the inference id and
+time in eventMetadata. decode_capture parses all the lines of a file into
+arrays: one entry per record for the metadata, one row per model input for
+the payloads, so a request with several rows (see testendpoint.py
+--batch-size) gives several rows.
+
+The JSON lines are parsed with orjson or ujson when installed. The CSV
+payloads of all the records are joined and converted to numbers at once,
+the content types may have parameters like "text/csv; utf-8".
+"""
+import base64
+import json
+import io
+
+import numpy as np
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _loads = ujson.loads
+    except ImportError:
+        _loads = json.loads
+
+CSV = "text/csv"
+JSON = "application/json"
+NPY = "application/x-npy"
+RAW_FLOAT32 = "application/x-float32"
+
+
+def media_type(content_type):
+    """Content type without its parameters, like charset"""
+    return content_type.split(";")[0].strip().lower()
+
+
+def _csv_values(text):
+    """Numbers of a CSV text, one conversion for all its rows"""
+    return np.fromstring(text.replace("\n", ","), dtype=np.float64, sep=",")
+
+
+def _csv_rows(payloads):
+    """2D array of the rows of all the CSV payloads, and rows per payload"""
+    texts = [data.strip() for data in payloads]
+    rows = np.array(
+        [text.count("\n") + 1 if text else 0 for text in texts], dtype=int)
+    joined = "\n".join(text for text in texts if text)
+    if not joined:
+        return np.empty((0, 0)), rows
+    width = joined.split("\n", 1)[0].count(",") + 1
+    values = _csv_values(joined)
+    if values.size != rows.sum() * width:
+        raise ValueError(
+            f"CSV payloads are not {rows.sum()} rows of {width} numbers")
+    return values.reshape(-1, width), rows
+
+
+def _payload_rows(payload, n_features=None, column=False):
+    """2D array of the rows of a payload of any supported content type"""
+    content_type = media_type(payload["observedContentType"])
+    data = payload["data"]
+    if payload.get("encoding") == "BASE64":
+        data = base64.b64decode(data)
+    elif isinstance(data, str) and content_type in (NPY, RAW_FLOAT32):
+        data = data.encode("latin-1")
+
+    if content_type == CSV:
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return _csv_rows([data])[0]
+    if content_type == JSON:
+        values = np.asarray(_loads(data), dtype=np.float64)
+    elif content_type == NPY:
+        values = np.load(io.BytesIO(data), allow_pickle=False)
+    elif content_type == RAW_FLOAT32:
+        values = np.frombuffer(data, dtype="<f4").astype(np.float64)
+        if n_features and not column:
+            return values.reshape(-1, n_features)
+    else:
+        raise ValueError(f"Cannot decode {content_type} payloads")
+    if values.ndim < 2:
+        return values.reshape(-1, 1) if column else values.reshape(1, -1)
+    return values
+
+
+def decode_payloads(payloads, n_features=None, column=False):
+    """Rows of all the payloads as one 2D array, and the rows per payload
+
+    The common case of CSV payloads only is parsed at once, other content
+    types one payload at a time. Arrays without rows, like a JSON list or
+    raw float32 values, are a single row, or with column=True (for the
+    predictions) one value per row. n_features gives the rows of the
+    application/x-float32 inputs.
+    """
+    if all(media_type(p["observedContentType"]) == CSV and
+           p.get("encoding") != "BASE64" for p in payloads):
+        return _csv_rows([p["data"] for p in payloads])
+    arrays = [_payload_rows(p, n_features, column) for p in payloads]
+    rows = np.array([len(a) for a in arrays], dtype=int)
+    width = max((a.shape[1] for a in arrays if len(a)), default=0)
+    if any(len(a) and a.shape[1] != width for a in arrays):
+        raise ValueError("Payloads with different number of columns")
+    return np.concatenate(
+        [a for a in arrays if len(a)] or [np.empty((0, width))]), rows
+
+
+def decode_capture(lines, inputs=True, n_features=None):
+    """Columns of the records of a data capture file
+
+    lines is an iterable of the JSON lines of the file (str or bytes).
+    Returns a dict with, for each record, "inference_id", "event_id",
+    "inference_time" (datetime64[ms]) and "rows", the number of
+    predictions, and for each row "output", the predictions, and "input"
+    the features, unless inputs is False. Predictions are a 1D array when
+    the model gives one value per row.
+    """
+    records = [_loads(line) for line in lines if line.strip()]
+    metadata = [record["eventMetadata"] for record in records]
+    captures = [record["captureData"] for record in records]
+
+    output, rows = decode_payloads(
+        [c["endpointOutput"] for c in captures], column=True)
+    if output.ndim == 2 and output.shape[1] == 1:
+        output = output[:, 0]
+    columns = {
+        "inference_id": np.array(
+            [m.get("inferenceId") for m in metadata], dtype=object),
+        "event_id": np.array(
+            [m.get("eventId") for m in metadata], dtype=object),
+        "inference_time": np.array(
+            [m["inferenceTime"].rstrip("Z") for m in metadata],
+            dtype="datetime64[ms]"),
+        "rows": rows,
+        "output": output,
+    }
+    if inputs:
+        columns["input"], input_rows = decode_payloads(
+            [c["endpointInput"] for c in captures], n_features)
+        if not np.array_equal(input_rows, rows):
+            raise ValueError("Records with different input and output rows")
+    return columns
+
+
+def split_rows(columns, name="output"):
+    """Rows of a column of decode_capture, split per record"""
+    return np.split(columns[name], np.cumsum(columns["rows"])[:-1])
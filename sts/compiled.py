@@ -0,0 +1,67 @@
+"""Linear model predictions with plain NumPy
+
+A fitted sklearn linear classifier (like the LogisticRegression trained by
+training.py) is exported to a small .npz file with its coefficients,
+intercept and classes. LinearPredictor loads it and predicts with a single
+matrix product, without sklearn's input validation on every call.
+"""
+import numpy as np
+
+
+def export_linear_model(model, path):
+    """Write the coefficients, intercept and classes of model to a .npz"""
+    np.savez(
+        path,
+        coef=np.asarray(model.coef_, dtype=np.float64),
+        intercept=np.asarray(model.intercept_, dtype=np.float64).ravel(),
+        classes=np.asarray(model.classes_))
+
+
+class LinearPredictor:
+    """predict and decision_function of a linear classifier
+
+    The attribute names are the same as in sklearn.
+    """
+
+    def __init__(self, coef, intercept, classes):
+        self.coef_ = np.asarray(coef, dtype=np.float64)
+        self.intercept_ = np.asarray(intercept, dtype=np.float64)
+        self.classes_ = np.asarray(classes)
+        self._coef_t = np.ascontiguousarray(self.coef_.T)
+
+    @classmethod
+    def load(cls, path):
+        """Read a model written by export_linear_model"""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["coef"], data["intercept"], data["classes"])
+
+    def decision_function(self, X):
+        scores = np.asarray(X) @ self._coef_t + self.intercept_
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.ndim == 1:
+            indices = (scores > 0).astype(int)
+        else:
+            indices = scores.argmax(axis=1)
+        return self.classes_[indices]
+
+
+def check_parity(model, predictor, X):
+    """Raise ValueError if predictor and model give different results on X
+
+    X is compared in float64: with float32 data, like the npy splits, recent
+    sklearn versions compute the decision function in float32 too, which is
+    far from the float64 product of the predictor for the tolerance.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    expected = model.decision_function(X)
+    scores = predictor.decision_function(X)
+    if not np.allclose(scores, expected, rtol=1e-9, atol=1e-9):
+        raise ValueError(
+            "Decision function differs from sklearn by up to {}".format(
+                np.abs(scores - expected).max()))
+    mismatches = np.sum(predictor.predict(X) != model.predict(X))
+    if mismatches:
+        raise ValueError(f"{mismatches} predictions differ from sklearn")
@@ -1,4 +1,6 @@
 """Evaluation script for measuring mean squared error."""
+import os
+import sys
 import json
 import logging
 import pathlib
@@ -12,12 +14,15 @@ import pandas as pd
 from sklearn.metrics import mean_squared_error
 import joblib
 
+# splits.py is given to the processing job as an input, see pipeline.py
+sys.path.append("/opt/ml/processing/splits")
+from splits import load_split
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 
-
 if __name__ == "__main__":
     logger.debug("Starting evaluation.")
     logger.info(run("ls /opt/ml/processing/model/", shell=True))
@@ -31,13 +36,11 @@ if __name__ == "__main__":
     model = joblib.load("model.joblib")
 
     logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
+    test = load_split("/opt/ml/processing/test", "test")
 
     logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = df.values
+    y_test = np.asarray(test[:, 0])
+    X_test = np.asarray(test[:, 1:])
 
     logger.info("Performing predictions against test data.")
     predictions = model.predict(X_test)
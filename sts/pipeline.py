@@ -132,6 +132,21 @@ def get_pipeline(
         default_value=f"s3://sts-datwit-dataset/stsmsrpc.txt",
     )
 
+    # csv, npy (binary, with a manifest) or both
+    dataset_format = ParameterString(
+        name="DatasetFormat", default_value="csv",
+    )
+
+    # S3 uri of the .npz pair feature cache, disabled if empty
+    feature_cache_uri = ParameterString(
+        name="FeatureCacheUrl", default_value="",
+    )
+
+    # named subset of distance features, see _METRIC_SUBSETS_ in preprocess.py
+    metric_subset = ParameterString(
+        name="MetricSubset", default_value="all",
+    )
+
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
         framework_version="0.23-1",
@@ -154,7 +169,12 @@ def get_pipeline(
                             source="/opt/ml/processing/test"),
         ],
         code=os.path.join(BASE_DIR, "preprocess.py"),
-        job_arguments=["--input-data", input_data],
+        job_arguments=[
+            "--input-data", input_data,
+            "--output-format", dataset_format,
+            "--feature-cache", feature_cache_uri,
+            "--metric-subset", metric_subset,
+        ],
     )
 
     # training step for generating model artifacts
@@ -227,6 +247,11 @@ def get_pipeline(
                 ].S3Output.S3Uri,
                 destination="/opt/ml/processing/test",
             ),
+            ProcessingInput(
+                source=os.path.join(BASE_DIR, "splits.py"),
+                destination="/opt/ml/processing/splits",
+                input_name="splits",
+            ),
         ],
         outputs=[
             ProcessingOutput(output_name="evaluation",
@@ -261,6 +286,11 @@ def get_pipeline(
                 ].S3Output.S3Uri,
                 destination="/opt/ml/processing/validation",
             ),
+            ProcessingInput(
+                source=os.path.join(BASE_DIR, "splits.py"),
+                destination="/opt/ml/processing/splits",
+                input_name="splits",
+            ),
         ],
         outputs=[
             ProcessingOutput(output_name="validate",
@@ -284,8 +314,10 @@ def get_pipeline(
         name="RegisterSTSModel",
         estimator=sklearn_estimator,
         model_data=step_train.properties.ModelArtifacts.S3ModelArtifacts,
-        content_types=["text/csv"],
-        response_types=["text/csv"],
+        content_types=[
+            "text/csv", "application/x-sentence-pairs+json",
+            "application/x-npy", "application/x-float32"],
+        response_types=["text/csv", "application/x-npy", "application/x-float32"],
         inference_instances=["ml.m5.xlarge"],
         transform_instances=["ml.m5.xlarge"],
         model_package_group_name=model_package_group_name,
@@ -319,6 +351,9 @@ def get_pipeline(
             training_instance_type,
             model_approval_status,
             input_data,
+            dataset_format,
+            feature_cache_uri,
+            metric_subset,
         ],
         steps=[step_preprocess, step_train, step_eval, step_cond],
         sagemaker_session=sagemaker_session,
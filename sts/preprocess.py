@@ -2,52 +2,883 @@
 
 import os
 import csv
+import hashlib
+import json
+import codecs
+import collections
+import time
 import pickle
 import string
 import pathlib
 import boto3
+from botocore.exceptions import ClientError
 import logging
 import argparse
 import warnings
 import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.preprocessing import MaxAbsScaler
 from sklearn.metrics.pairwise import * #support sparse matrix inputs
 from scipy.spatial.distance import * #do not support sparse matrix inputs
 
-warnings.filterwarnings(action='ignore')
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.addHandler(logging.StreamHandler())
+logger = logging.getLogger(__name__)
 
 # helper functions
-def count_words(list_of_words):
-    """"""
-    corpus_dict = {}
-    for w in list_of_words:
-        corpus_dict[w] = corpus_dict.get(w, 0.0) + 1.0
-        
-    return corpus_dict
-
-def CountVectorizer(string_dict, set_both_strings):
-    """Whit padding included""" 
-    vector = []
-    for key in set_both_strings: 
-        if key in string_dict: 
-            vector.append(int(string_dict[key])) 
-        else:
-            vector.append(0)
-    return vector
 
-def min_max_range(x, range_values):
-    return [round(((xx-min(x))/(1.0*(max(x)-min(x))))*(range_values[1]-range_values[0])+range_values[0],5) for xx in x]
+# translation table that removes the punctuation, built once
+_PUNCTUATION_TABLE_ = str.maketrans("", "", string.punctuation)
+
+
+def tokenize(sentence):
+    """Split a sentence in words, punctuation removed"""
+    return sentence.translate(_PUNCTUATION_TABLE_).split()
+
+
+def _counts_matrix(indices, indptr, n_tokens):
+    """CSR token counts from the token ids of each row"""
+    indices = np.asarray(indices, dtype=np.int32)
+    data = np.ones(len(indices), dtype=np.int32)
+    m = sp.csr_matrix(
+        (data, indices, np.asarray(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, n_tokens))
+    # repeated words in a sentence become a count
+    m.sum_duplicates()
+    return m
+
+
+def encode_pairs(sentences, vocabulary=None):
+    """Token counts of the sentence pairs over a corpus wide vocabulary
+
+    Args:
+        sentences: iterable of (sentence 1, sentence 2) tuples
+        vocabulary: token -> column dict, new tokens are added to it
+
+    Returns:
+        (left, right, vocabulary), left and right are int32 CSR matrices with
+        one row per pair, aligned on the same token columns
+    """
+    vocabulary = {} if vocabulary is None else vocabulary
+    indices = ([], [])
+    indptr = ([0], [0])
+    for pair in sentences:
+        for side in (0, 1):
+            indices[side].extend(
+                vocabulary.setdefault(token, len(vocabulary))
+                for token in tokenize(pair[side]))
+            indptr[side].append(len(indices[side]))
+
+    left = _counts_matrix(indices[0], indptr[0], len(vocabulary))
+    right = _counts_matrix(indices[1], indptr[1], len(vocabulary))
+    return left, right, vocabulary
+
+
+'''
+Batched distances
+
+Each sentence pair is a row in two aligned sparse count matrices (left and
+right sentences) sharing the same token columns. Only the tokens present in
+at least one of the two sentences take part in the distance of a pair, so
+"k" below is the size of the pair vocabulary and not the number of columns
+of the matrices.
+'''
+
+_VALID_METRICS_ = ['euclidean', 'l2', 'l1', 'manhattan', 'cityblock',
+    'braycurtis', 'canberra', 'chebyshev', 'correlation',
+    'cosine', 'dice', 'hamming', 'jaccard', 'kulsinski',
+    'matching', 'minkowski', 'rogerstanimoto',
+    'russellrao', 'seuclidean', 'sokalmichener',
+    'sokalsneath', 'sqeuclidean', 'yule',]
+
+# named feature subsets, "distinct" drops the metrics that are aliases of
+# another one (minkowski is euclidean with the default p=2) and the boolean
+# metrics equal to another one: over the vocabulary of the pair no token is
+# absent from both sentences (nff is 0), so matching and russellrao are
+# jaccard, and rogerstanimoto and sokalsneath are kulsinski
+_METRIC_SUBSETS_ = {
+    'all': _VALID_METRICS_,
+    'distinct': [m for m in _VALID_METRICS_ if m not in (
+        'l2', 'manhattan', 'cityblock', 'minkowski', 'sokalmichener',
+        'matching', 'russellrao', 'rogerstanimoto', 'sokalsneath')],
+    'numeric': [m for m in _VALID_METRICS_ if m in (
+        'euclidean', 'l2', 'l1', 'manhattan', 'cityblock', 'braycurtis',
+        'canberra', 'chebyshev', 'correlation', 'cosine', 'hamming',
+        'minkowski', 'seuclidean', 'sqeuclidean')],
+    'boolean': [m for m in _VALID_METRICS_ if m in (
+        'dice', 'jaccard', 'kulsinski', 'matching', 'rogerstanimoto',
+        'russellrao', 'sokalmichener', 'sokalsneath', 'yule')],
+}
+
+
+def _row_sum(m):
+    """Sum of each row of a sparse matrix as a flat float64 array"""
+    return np.asarray(m.sum(axis=1), dtype=np.float64).ravel()
+
+
+def _pair_sizes(left, right):
+    """Number of tokens present in either sentence of each pair"""
+    union = abs(left) + abs(right)
+    union.eliminate_zeros()
+    return np.diff(union.indptr)
+
+
+def _sqeuclidean(left, right, k, p):
+    diff = left - right
+    return _row_sum(diff.multiply(diff))
+
+
+def _euclidean(left, right, k, p):
+    return np.sqrt(_sqeuclidean(left, right, k, p))
+
+
+def _cityblock(left, right, k, p):
+    return _row_sum(abs(left - right))
+
+
+def _chebyshev(left, right, k, p):
+    return abs(left - right).max(axis=1).toarray().ravel()
+
+
+def _minkowski(left, right, k, p):
+    if np.isinf(p):
+        return _chebyshev(left, right, k, p)
+    return _row_sum(abs(left - right).power(p)) ** (1.0 / p)
+
+
+def _cosine(left, right, k, p):
+    uv = _row_sum(left.multiply(right))
+    norms = np.sqrt(_row_sum(left.multiply(left)) * _row_sum(right.multiply(right)))
+    # sklearn leaves zero norm rows as zero vectors, similarity 0
+    similarity = np.divide(uv, norms, out=np.zeros_like(uv), where=norms != 0)
+    return np.clip(1.0 - similarity, 0.0, 2.0)
+
+
+def _correlation(left, right, k, p):
+    # centered sums over the k pair tokens, scaled by k to stay in integers
+    su, sv = _row_sum(left), _row_sum(right)
+    cov = k * _row_sum(left.multiply(right)) - su * sv
+    var_u = k * _row_sum(left.multiply(left)) - su * su
+    var_v = k * _row_sum(right.multiply(right)) - sv * sv
+    # constant vectors have no correlation, scipy gives nan
+    correlation = np.clip(cov / np.sqrt(var_u * var_v), -1.0, 1.0)
+    return 1.0 - correlation
+
+
+def _braycurtis(left, right, k, p):
+    return _row_sum(abs(left - right)) / _row_sum(abs(left + right))
+
+
+def _canberra(left, right, k, p):
+    denominator = abs(left) + abs(right)
+    denominator.eliminate_zeros()
+    # terms with a zero denominator count as 0, the same as scipy
+    return _row_sum(abs(left - right).multiply(denominator.power(-1)))
+
+
+def _hamming(left, right, k, p):
+    # not a boolean metric for sklearn: counts are compared as numbers
+    diff = left - right
+    diff.eliminate_zeros()
+    return np.diff(diff.indptr) / k
+
+
+def _seuclidean(left, right, k, p):
+    # sklearn estimates the variance V from the two rows of the pair, so
+    # V_j = (u_j - v_j)^2 / 2 and every differing token adds exactly 2, while
+    # a token with the same count in both sentences gives 0/0 (nan)
+    diff = left - right
+    diff.eliminate_zeros()
+    n_diff = np.diff(diff.indptr)
+    return np.where(n_diff == k, np.sqrt(2.0 * n_diff), np.nan)
+
+
+# metric name -> batched implementation, aliases share the implementation
+_NUMERIC_METRICS_ = {
+    'euclidean': _euclidean,
+    'l2': _euclidean,
+    'l1': _cityblock,
+    'manhattan': _cityblock,
+    'cityblock': _cityblock,
+    'braycurtis': _braycurtis,
+    'canberra': _canberra,
+    'chebyshev': _chebyshev,
+    'correlation': _correlation,
+    'cosine': _cosine,
+    'hamming': _hamming,
+    'minkowski': _minkowski,
+    'seuclidean': _seuclidean,
+    'sqeuclidean': _sqeuclidean,
+}
+
+
+def numeric_distances(left, right, metrics=None, p=2):
+    """Numeric distances between the aligned rows of two count matrices
+
+    Args:
+        left: (n_pairs, n_tokens) sparse counts of the first sentences
+        right: (n_pairs, n_tokens) sparse counts of the second sentences
+        metrics: names from _NUMERIC_METRICS_, all of them by default
+        p: the order of the minkowski distance
+
+    Returns:
+        (n_pairs, len(metrics)) float64 array, pairs without tokens are nan
+    """
+    metrics = list(_NUMERIC_METRICS_) if metrics is None else list(metrics)
+    unknown = [m for m in metrics if m not in _NUMERIC_METRICS_]
+    if unknown:
+        raise ValueError(f"Unsupported numeric metrics: {unknown}")
+
+    left = sp.csr_matrix(left, dtype=np.float64)
+    right = sp.csr_matrix(right, dtype=np.float64)
+    if left.shape != right.shape:
+        raise ValueError(
+            f"Unaligned pairs: {left.shape} and {right.shape}")
+
+    # the minkowski distance of order 2 is the euclidean distance
+    funcs = [
+        _euclidean if m == 'minkowski' and p == 2 else _NUMERIC_METRICS_[m]
+        for m in metrics]
+    k = _pair_sizes(left, right)
+    columns = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for func in funcs:
+            if func not in columns:
+                columns[func] = func(left, right, k, p)
+
+    distances = np.empty((left.shape[0], len(metrics)), dtype=np.float64)
+    for j, func in enumerate(funcs):
+        distances[:, j] = columns[func]
+    distances[k == 0] = np.nan
+    return distances
+
+
+def _presence(m):
+    """Sparse 0/1 matrix with the tokens present in each row"""
+    m = sp.csr_matrix(m, dtype=np.float64, copy=True)
+    m.eliminate_zeros()
+    m.data[:] = 1.0
+    return m
+
+
+def presence_counts(left, right):
+    """Token presence counts of each pair, computed for all pairs at once
+
+    Returns:
+        (ntt, ntf, nft, nff): tokens in both sentences, only in the left one,
+        only in the right one and in neither, over the pair vocabulary
+    """
+    u, v = _presence(left), _presence(right)
+    ntt = _row_sum(u.multiply(v))
+    ntf = _row_sum(u) - ntt
+    nft = _row_sum(v) - ntt
+    nff = _pair_sizes(u, v) - ntt - ntf - nft
+    return ntt, ntf, nft, nff
+
+
+def _dice(ntt, ntf, nft, nff):
+    return (ntf + nft) / (2.0 * ntt + ntf + nft)
+
+
+def _jaccard(ntt, ntf, nft, nff):
+    # scipy returns 0 for two empty vectors
+    union = ntt + ntf + nft
+    return np.divide(
+        ntf + nft, union, out=np.zeros_like(union), where=union != 0)
+
+
+def _kulsinski(ntt, ntf, nft, nff):
+    n = ntt + ntf + nft + nff
+    return (ntf + nft - ntt + n) / (ntf + nft + n)
+
+
+def _matching(ntt, ntf, nft, nff):
+    return (ntf + nft) / (ntt + ntf + nft + nff)
+
+
+def _rogerstanimoto(ntt, ntf, nft, nff):
+    r = 2.0 * (ntf + nft)
+    return r / (ntt + nff + r)
+
+
+def _russellrao(ntt, ntf, nft, nff):
+    n = ntt + ntf + nft + nff
+    return (n - ntt) / n
+
+
+def _sokalsneath(ntt, ntf, nft, nff):
+    r = 2.0 * (ntf + nft)
+    return r / (ntt + r)
+
+
+def _yule(ntt, ntf, nft, nff):
+    # scipy returns 0 when no token is present in only one of the sentences
+    half_r = ntf * nft
+    denominator = ntt * nff + half_r
+    return np.divide(
+        2.0 * half_r, denominator,
+        out=np.zeros_like(half_r), where=half_r != 0)
+
+
+# metric name -> implementation from the presence counts, sklearn converts
+# the data to boolean for all of these (hamming is not one of them)
+_BOOLEAN_METRICS_ = {
+    'dice': _dice,
+    'jaccard': _jaccard,
+    'kulsinski': _kulsinski,
+    'matching': _matching,
+    'rogerstanimoto': _rogerstanimoto,
+    'russellrao': _russellrao,
+    'sokalmichener': _rogerstanimoto,
+    'sokalsneath': _sokalsneath,
+    'yule': _yule,
+}
+
+
+def boolean_distances(left, right, metrics=None):
+    """Boolean distances between the aligned rows of two count matrices
+
+    The presence counts are computed once and every metric is derived from
+    them, the degenerate 0/0 cases give the same values as scipy.
+
+    Args:
+        left: (n_pairs, n_tokens) sparse counts of the first sentences
+        right: (n_pairs, n_tokens) sparse counts of the second sentences
+        metrics: names from _BOOLEAN_METRICS_, all of them by default
+
+    Returns:
+        (n_pairs, len(metrics)) float64 array, pairs without tokens are nan
+    """
+    metrics = list(_BOOLEAN_METRICS_) if metrics is None else list(metrics)
+    unknown = [m for m in metrics if m not in _BOOLEAN_METRICS_]
+    if unknown:
+        raise ValueError(f"Unsupported boolean metrics: {unknown}")
+    if left.shape != right.shape:
+        raise ValueError(
+            f"Unaligned pairs: {left.shape} and {right.shape}")
+
+    counts = presence_counts(left, right)
+    n = sum(counts)
+    columns = {}
+    distances = np.empty((left.shape[0], len(metrics)), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for j, metric in enumerate(metrics):
+            func = _BOOLEAN_METRICS_[metric]
+            if func not in columns:
+                columns[func] = func(*counts)
+            distances[:, j] = columns[func]
+    distances[n == 0] = np.nan
+    return distances
+
+
+def pairwise_fallback(left, right, metric):
+    """Per pair distances with sklearn, for metrics without a batched kernel"""
+    left = sp.csr_matrix(left)
+    right = sp.csr_matrix(right)
+    distances = np.full(left.shape[0], np.nan)
+    for i in range(left.shape[0]):
+        tokens = np.union1d(left[i].indices, right[i].indices)
+        if tokens.size == 0:
+            continue
+        s1 = left[i][:, tokens].toarray().astype(np.int32)
+        s2 = right[i][:, tokens].toarray().astype(np.int32)
+        _, dist = pairwise_distances_argmin_min(s1, s2, axis=1, metric=metric)
+        distances[i] = dist[0]
+    return distances
+
+
+def distance_features(left, right, metrics=_VALID_METRICS_):
+    """Feature matrix with one column per metric, in the given order"""
+    numeric = [m for m in metrics if m in _NUMERIC_METRICS_]
+    boolean = [m for m in metrics if m in _BOOLEAN_METRICS_]
+    columns = dict(zip(numeric, numeric_distances(left, right, numeric).T))
+    columns.update(zip(boolean, boolean_distances(left, right, boolean).T))
+    for metric in metrics:
+        if metric not in columns:
+            columns[metric] = pairwise_fallback(left, right, metric)
+
+    return np.column_stack([columns[m] for m in metrics])
+
+
+def featurize(sentences, metrics=_VALID_METRICS_):
+    """Distance features of a list of (sentence 1, sentence 2) pairs"""
+    if not sentences:
+        return np.empty((0, len(metrics)), dtype=np.float64)
+    left, right, _ = encode_pairs(sentences)
+    return distance_features(left, right, metrics)
+
+
+def _featurize_chunk(task):
+    """Process pool worker, returns the chunk index and the time spent"""
+    index, chunk, metrics = task
+    start = time.perf_counter()
+    features = featurize(chunk, metrics)
+    return index, features, time.perf_counter() - start
+
+
+def featurize_chunks(chunks, metrics=_VALID_METRICS_, workers=None):
+    """Distance features of chunks of pairs, computed in a process pool
+
+    The chunks are consumed lazily, at most two per worker are pending at
+    any time, and the features are yielded in input order, so for the same
+    chunks the result does not depend on the number of workers.
+
+    Args:
+        chunks: iterable of lists of (sentence 1, sentence 2) tuples
+        metrics: the feature columns, in order
+        workers: number of processes, all the available cores by default
+
+    Yields:
+        (len(chunk), len(metrics)) float64 array for each chunk
+    """
+    workers = workers or os.cpu_count() or 1
+    logger.info("Computing features with %d workers.", workers)
+
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for task in enumerate(chunks):
+            pending.append(
+                executor.submit(_featurize_chunk, task + (metrics,)))
+            if len(pending) >= 2 * workers:
+                yield _chunk_result(pending.popleft())
+        while pending:
+            yield _chunk_result(pending.popleft())
+
+
+def _chunk_result(future):
+    """Wait for a chunk of features and log the throughput"""
+    index, features, elapsed = future.result()
+    logger.info(
+        "Chunk %d: %d pairs in %.2fs (%.0f pairs/s).",
+        index, len(features), elapsed,
+        len(features) / elapsed if elapsed else float('inf'))
+    return features
+
+
+def parallel_featurize(
+        sentences, metrics=_VALID_METRICS_, workers=None, chunk_size=10000):
+    """Distance features of a list of pairs, computed by chunks
+
+    Args:
+        sentences: list of (sentence 1, sentence 2) tuples
+        metrics: the feature columns, in order
+        workers: number of processes, all the available cores by default
+        chunk_size: number of pairs sent to a worker at once
+
+    Returns:
+        (n_pairs, len(metrics)) float64 array
+    """
+    chunks = (
+        sentences[start:start + chunk_size]
+        for start in range(0, len(sentences), chunk_size))
+    features = list(featurize_chunks(chunks, metrics, workers))
+    if not features:
+        return np.empty((0, len(metrics)), dtype=np.float64)
+    return np.concatenate(features)
+
+
+def profile_metrics(sentences, metrics=_VALID_METRICS_, repeat=3):
+    """Wall time in seconds of each metric alone on the given pairs
+
+    The time includes the setup shared by the metrics of the same kernel,
+    the best of repeat runs is reported.
+    """
+    left, right, _ = encode_pairs(sentences)
+    timings = {}
+    for metric in metrics:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            distance_features(left, right, [metric])
+            best = min(best, time.perf_counter() - start)
+        timings[metric] = best
+    return timings
+
+
+def feature_correlation(X):
+    """Pearson correlation between the feature columns
+
+    Missing values are replaced by the mean of their column, constant
+    columns have a nan correlation.
+    """
+    X = np.array(X, dtype=np.float64)
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        means = np.nanmean(X, axis=0)
+        X = np.where(np.isnan(X), means, X)
+        return np.corrcoef(X, rowvar=False)
+
+
+def log_profile(timings, correlation, metrics, threshold=0.95):
+    """Log the metric costs and the pairs of nearly collinear features"""
+    total = sum(timings.values())
+    logger.info("Metric wall time (best run):")
+    for metric, seconds in sorted(timings.items(), key=lambda t: -t[1]):
+        logger.info(
+            "  %-15s %9.4fs %5.1f%%", metric, seconds,
+            100.0 * seconds / total if total else 0.0)
+    logger.info("Feature pairs with |correlation| >= %.2f:", threshold)
+    for i, j in zip(*np.triu_indices(len(metrics), k=1)):
+        if abs(correlation[i, j]) >= threshold:
+            logger.info(
+                "  %-15s %-15s %.4f", metrics[i], metrics[j], correlation[i, j])
+
+
+'''
+Feature cache
+
+The distance features only depend on the two sentences of a pair, so the
+features of pairs seen in a previous run are kept in a cache and only the
+new pairs are sent to the feature workers.
+'''
+
+
+def pair_keys(sentences):
+    """64 bit hash of each pair, from the tokens without punctuation"""
+    keys = np.empty(len(sentences), dtype=np.uint64)
+    for i, (s1, s2) in enumerate(sentences):
+        text = " ".join(tokenize(s1)) + "\t" + " ".join(tokenize(s2))
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+        keys[i] = int.from_bytes(digest, "little")
+    return keys
+
+
+class FeatureCache:
+    """Distance features of the already seen pairs, by pair key
+
+    The cache keeps at most max_size pairs, when it is full the pairs not
+    used for the most runs are evicted first. It is stored as a single .npz
+    file with the keys, the features and the run each pair was last used.
+    """
+
+    def __init__(self, metrics, max_size=1000000):
+        self.metrics = list(metrics)
+        self.max_size = max_size
+        self.keys = np.empty(0, dtype=np.uint64)  # sorted
+        self.features = np.empty((0, len(self.metrics)), dtype=np.float64)
+        self.last_used = np.empty(0, dtype=np.int64)
+        self.run = 0
+        self.hits = self.misses = self.evicted = 0
+
+    @classmethod
+    def load(cls, path, metrics, max_size=1000000):
+        """Read a cache saved with save, an empty one if there is none"""
+        cache = cls(metrics, max_size)
+        if not os.path.exists(path):
+            logger.info("No feature cache in %s, starting empty.", path)
+            return cache
+        with np.load(path) as data:
+            if list(data["metrics"]) != cache.metrics:
+                logger.info("Feature cache metrics differ, starting empty.")
+                return cache
+            cache.keys = data["keys"]
+            cache.features = data["features"]
+            cache.last_used = data["last_used"]
+            cache.run = int(data["run"]) + 1
+        logger.info("Loaded %d pairs from feature cache.", len(cache.keys))
+        return cache
+
+    def save(self, path):
+        """Write the cache, replacing the previous file only when done"""
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path, keys=self.keys, features=self.features,
+            last_used=self.last_used, run=self.run,
+            metrics=np.array(self.metrics))
+        os.replace(tmp_path, path)
+
+    def lookup(self, keys):
+        """Features of the given pair keys
+
+        Returns:
+            (features, found), the rows of the pairs not in the cache are nan
+        """
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.keys):
+            found = self.keys[positions] == keys
+        features = np.full((len(keys), len(self.metrics)), np.nan)
+        features[found] = self.features[positions[found]]
+        self.last_used[positions[found]] = self.run
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        return features, found
+
+    def update(self, keys, features):
+        """Add the features of new pairs, evicting old ones if needed"""
+        keys, first = np.unique(keys, return_index=True)
+        new = ~np.isin(keys, self.keys)
+        keys = np.concatenate([self.keys, keys[new]])
+        features = np.concatenate([self.features, features[first[new]]])
+        last_used = np.concatenate([
+            self.last_used, np.full(new.sum(), self.run, dtype=np.int64)])
+
+        if len(keys) > self.max_size:
+            # most recently used first, stable for the same run
+            keep = np.argsort(-last_used, kind="stable")[:self.max_size]
+            self.evicted += len(keys) - self.max_size
+            keys, features, last_used = keys[keep], features[keep], last_used[keep]
+
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.features = features[order]
+        self.last_used = last_used[order]
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        logger.info(
+            "Feature cache: %d hits, %d misses (%.1f%% hit rate), "
+            "%d pairs stored, %d evicted.",
+            self.hits, self.misses, 100.0 * self.hits / total if total else 0.0,
+            len(self.keys), self.evicted)
+
+
+def cached_featurize_chunks(chunks, cache, metrics=_VALID_METRICS_, workers=None):
+    """Like featurize_chunks, but only the pairs missing from cache are computed"""
+    lookups = collections.deque()
+
+    def missing_pairs():
+        for chunk in chunks:
+            keys = pair_keys(chunk)
+            features, found = cache.lookup(keys)
+            lookups.append((keys, features, found))
+            yield [pair for pair, hit in zip(chunk, found) if not hit]
+
+    for computed in featurize_chunks(missing_pairs(), metrics, workers):
+        keys, features, found = lookups.popleft()
+        features[~found] = computed
+        cache.update(keys[~found], computed)
+        yield features
+
+
+def _cache_location(uri, local_dir):
+    """Local path of the cache file, downloaded first if uri is in S3"""
+    if not uri.startswith("s3://"):
+        return uri
+    bucket, key = uri.split("/")[2], "/".join(uri.split("/")[3:])
+    path = os.path.join(local_dir, os.path.basename(key))
+    try:
+        boto3.client("s3").download_file(bucket, key, path)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+    return path
+
+
+def s3_lines(bucket, key):
+    """Text lines of a S3 object, read while it is being downloaded"""
+    body = boto3.resource("s3").Object(bucket, key).get()["Body"]
+    return codecs.getreader("utf-8")(body, errors='ignore')
+
+
+def read_chunks(lines, chunk_size, stats):
+    """Parse the dataset rows by chunks of (sentence pairs, labels)
+
+    Expected format is: Quality ID#1 ID#2 String#1 String#2, tab separated
+    and with a header row. The rows that can't be parsed are skipped and
+    counted in stats["malformed"], the good ones in stats["rows"].
+    """
+    csv_reader = csv.reader(lines, delimiter='\t')
+    # skip first (header) row
+    next(csv_reader, None)
+    sentences, y = [], []
+    for row in csv_reader:
+        try:
+            pair, label = (row[3], row[4]), float(row[0])
+        except (IndexError, ValueError):
+            stats["malformed"] += 1
+            logger.debug("Malformed row %d: %r", csv_reader.line_num, row)
+            continue
+        stats["rows"] += 1
+        sentences.append(pair)
+        y.append(label)
+        if len(sentences) == chunk_size:
+            yield sentences, y
+            sentences, y = [], []
+    if sentences:
+        yield sentences, y
+
+
+'''
+Scaling
+
+The scaling parameters are fitted on the features of the train split and
+saved as JSON next to the datasets, so the same transform can be applied to
+the validation and test splits and to new data without the training set.
+Modes:
+
+- row: min-max of each row to feature_range, rounded to 5 decimals
+- minmax: min-max of each column to feature_range
+- maxabs: each column divided by its maximum absolute value
+- standard: each column centered and divided by its standard deviation
+
+After scaling, the missing values are filled with the mean of the scaled
+train features.
+'''
+
+_SCALING_MODES_ = ('row', 'minmax', 'maxabs', 'standard')
+
+
+def _scale(X, params):
+    """Scaling without the imputation of missing values"""
+    X = np.asarray(X, dtype=np.float64)
+    mode = params["mode"]
+    low, high = params["feature_range"]
+    # rows without any value and constant rows are left as nan
+    with np.errstate(divide='ignore', invalid='ignore'), \
+            warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if mode == 'row':
+            x_min = np.nanmin(X, axis=1, keepdims=True)
+            x_max = np.nanmax(X, axis=1, keepdims=True)
+            X = (X - x_min) / (x_max - x_min) * (high - low) + low
+            return np.round(X, params["decimals"])
+
+        offset = np.asarray(params["offset"], dtype=np.float64)
+        scale = np.asarray(params["scale"], dtype=np.float64)
+        X = (X - offset) / scale
+        if mode == 'minmax':
+            X = X * (high - low) + low
+        return X
+
+
+def fit_scaling(X, mode='row', feature_range=(0.0, 1.0), metrics=None):
+    """Fit the scaling parameters on a (n_pairs, n_features) matrix
+
+    Args:
+        X: the distance features
+        mode: one of _SCALING_MODES_
+        feature_range: (low, high) target range of the min-max modes
+        metrics: feature column names, saved with the parameters
+
+    Returns:
+        dict of JSON serializable parameters for scale_features
+    """
+    if mode not in _SCALING_MODES_:
+        raise ValueError(f"Unknown scaling mode {mode}, use {_SCALING_MODES_}")
+    X = np.asarray(X, dtype=np.float64)
+    params = {
+        "mode": mode,
+        "feature_range": [float(v) for v in feature_range],
+        "decimals": 5,
+        "metrics": list(metrics) if metrics is not None else None,
+    }
+
+    with warnings.catch_warnings():
+        # all nan columns are left as they are
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if mode == 'minmax':
+            offset = np.nanmin(X, axis=0)
+            scale = np.nanmax(X, axis=0) - offset
+        elif mode == 'maxabs':
+            offset = np.zeros(X.shape[1])
+            scale = np.nanmax(np.abs(X), axis=0)
+        elif mode == 'standard':
+            offset = np.nanmean(X, axis=0)
+            scale = np.nanstd(X, axis=0)
+        if mode != 'row':
+            # constant columns are only shifted, the same as sklearn
+            scale[~np.isfinite(scale) | (scale == 0)] = 1.0
+            offset[~np.isfinite(offset)] = 0.0
+            params["offset"] = offset.tolist()
+            params["scale"] = scale.tolist()
+
+        fill_value = np.nanmean(_scale(X, params))
+    params["fill_value"] = float(fill_value) if np.isfinite(fill_value) else 0.0
+    return params
+
+
+def scale_features(X, params):
+    """Apply the scaling fitted by fit_scaling and fill the missing values"""
+    X = _scale(X, params)
+    X[np.isnan(X)] = params["fill_value"]
+    return X
+
+
+def save_scaling(params, path):
+    """Write the scaling parameters as JSON"""
+    with open(path, "w") as f:
+        json.dump(params, f, indent=2)
+
+
+def load_scaling(path):
+    """Read the scaling parameters written by save_scaling"""
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_split(data, directory, name, output_format='csv', columns=None):
+    """Write a dataset split, labels in the first column
+
+    csv is the text format read by pd.read_csv, npy a float32 column-major
+    .npy file that can be memory-mapped, described by {name}.manifest.json.
+
+    Args:
+        data: (n_rows, n_columns) array
+        directory: output directory
+        name: file name without extension, like "train"
+        output_format: csv, npy or both
+        columns: optional column names for the manifest
+    """
+    if output_format in ('csv', 'both'):
+        np.savetxt(os.path.join(directory, name + '.csv'), data, delimiter=",")
+    if output_format in ('npy', 'both'):
+        data = np.asfortranarray(data, dtype=np.float32)
+        np.save(os.path.join(directory, name + '.npy'), data)
+        manifest = {
+            "format": "npy",
+            "file": name + '.npy',
+            "dtype": "float32",
+            "shape": list(data.shape),
+            "label_column": 0,
+            "columns": list(columns) if columns is not None else None,
+        }
+        with open(os.path.join(directory, name + '.manifest.json'), "w") as f:
+            json.dump(manifest, f, indent=2)
 
 # main routine
 if __name__ == "__main__":
+    # only when run as the processing script, model_loader.py imports the
+    # featurization functions from this module
+    warnings.filterwarnings(action='ignore')
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().addHandler(logging.StreamHandler())
     logger.debug("Starting preprocessing.")
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-data", type=str, required=True)
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="feature engineering processes, defaults to all the cores")
+    parser.add_argument(
+        "--chunk-size", type=int, default=10000,
+        help="sentence pairs per feature engineering task")
+    parser.add_argument(
+        "--random-seed", type=int, default=None,
+        help="seed for the shuffle before the split")
+    parser.add_argument(
+        "--streaming", action="store_true",
+        help="read the input from S3 while it is downloaded, not from disk")
+    parser.add_argument(
+        "--scaling", type=str, default="row", choices=_SCALING_MODES_,
+        help="how the distance features are scaled")
+    parser.add_argument(
+        "--output-format", type=str, default="csv",
+        choices=("csv", "npy", "both"),
+        help="csv text files, npy binary files with a manifest, or both")
+    parser.add_argument(
+        "--feature-cache", type=str, default="",
+        help="local path or S3 uri of the .npz feature cache, none if empty")
+    parser.add_argument(
+        "--feature-cache-size", type=int, default=1000000,
+        help="maximum number of sentence pairs in the feature cache")
+    parser.add_argument(
+        "--metric-subset", type=str, default="all",
+        choices=sorted(_METRIC_SUBSETS_),
+        help="named subset of the distance features to compute")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="log the time of each metric and the feature correlations")
     args = parser.parse_args()
     input_data = args.input_data
 
@@ -66,91 +897,99 @@ if __name__ == "__main__":
     # bucket = "sts-demo-datasets"
     # key = "stsmsrpc.txt"
 
-    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
-
-    filename = f"{base_dir}/data/{key}"
-    s3_client = boto3.resource("s3")
-    s3_client.Bucket(bucket).download_file(key, filename)
-
-    logger.info("Reading downloaded data.")
-
-    sentences = []
-    y = [] # y-data
-    with open(filename, errors = 'ignore') as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter='\t')
-        # skip first (header) row
-        next(csv_reader)
-        for row in csv_reader:
-            try:
-                sentences.append((row[3], row[4]))
-                y.append(float(row[0]))
-            except:
-                pass
-
-    logger.info("Reading data finished.")
-    os.unlink(filename)
+    if args.streaming:
+        logger.info("Streaming data from bucket: %s, key: %s", bucket, key)
+        source = s3_lines(bucket, key)
+    else:
+        logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
+        filename = f"{base_dir}/data/{key}"
+        s3_client = boto3.resource("s3")
+        s3_client.Bucket(bucket).download_file(key, filename)
+        logger.info("Reading downloaded data.")
+        source = open(filename, errors = 'ignore')
 
     '''
     Feature Engineering
-    '''
 
-    _VALID_METRICS_ = ['euclidean', 'l2', 'l1', 'manhattan', 'cityblock',
-        'braycurtis', 'canberra', 'chebyshev', 'correlation',
-        'cosine', 'dice', 'hamming', 'jaccard', 'kulsinski',
-        'matching', 'minkowski', 'rogerstanimoto',
-        'russellrao', 'seuclidean', 'sokalmichener',
-        'sokalsneath', 'sqeuclidean', 'yule',]
-
-    distances_matrix = []
-    for s1, s2 in sentences:
-        # clean each pair of sentences
-        s1 = s1.translate(str.maketrans("", "", string.punctuation))
-        s2 = s2.translate(str.maketrans("", "", string.punctuation))
+    The rows are parsed by chunks and each chunk is sent to the feature
+    workers while the next one is read, only the labels and the features
+    are kept in memory.
+    '''
 
-        s1 = count_words(s1.split())
-        s2 = count_words(s2.split())
+    stats = collections.Counter()
+    y = [] # y-data
 
-        c = set(s1).union(set(s2))
+    timings = {}
 
-        s1 = CountVectorizer(s1, c)
-        s2 = CountVectorizer(s2, c)
+    def sentence_chunks(lines):
+        for sentences, labels in read_chunks(lines, args.chunk_size, stats):
+            if args.profile and not timings:
+                # profiled on the first chunk only
+                timings.update(profile_metrics(sentences, metrics))
+            y.extend(labels)
+            yield sentences
 
-        s1 = np.array(s1,dtype=np.int32)
-        s2 = np.array(s2,dtype=np.int32)
+    metrics = _METRIC_SUBSETS_[args.metric_subset]
+    logger.info(
+        "Metric subset %s: %d features.", args.metric_subset, len(metrics))
 
-        s1 = s1.reshape(1,-1)
-        s2 = s2.reshape(1,-1)
+    cache = None
+    if args.feature_cache:
+        cache_path = _cache_location(args.feature_cache, f"{base_dir}/data")
+        cache = FeatureCache.load(
+            cache_path, metrics, args.feature_cache_size)
 
+    with source as lines:
         # get all distances
-        vector = []
-        for distance in _VALID_METRICS_:
-            _, dist =  pairwise_distances_argmin_min(s1, s2, axis=1, metric=distance)
-            vector.append(dist[0])
+        distances_matrix = [np.empty((0, len(metrics)))]
+        if cache is None:
+            distances_matrix.extend(featurize_chunks(
+                sentence_chunks(lines), metrics, workers=args.workers))
+        else:
+            distances_matrix.extend(cached_featurize_chunks(
+                sentence_chunks(lines), cache, metrics,
+                workers=args.workers))
+        distances_matrix = np.concatenate(distances_matrix)
 
-        distances_matrix.append(vector)
+    logger.info(
+        "Reading data finished: %d rows, %d malformed rows skipped.",
+        stats["rows"], stats["malformed"])
+    if not args.streaming:
+        os.unlink(filename)
 
-    '''
-    Scaling
-    '''
-    _DISTANCE_MATRIX_NORM_ = []
-    for vector in distances_matrix:
-        _DISTANCE_MATRIX_NORM_.append(min_max_range(vector, (0.0,1.0)))
-    distances_matrix = np.array(_DISTANCE_MATRIX_NORM_)
+    if timings:
+        log_profile(timings, feature_correlation(distances_matrix), metrics)
 
-    '''
-    Clean null values if any
-    '''
+    if cache is not None:
+        cache.log_stats()
+        cache.save(cache_path)
+        if args.feature_cache.startswith("s3://"):
+            logger.info("Uploading feature cache to %s", args.feature_cache)
+            boto3.client("s3").upload_file(
+                cache_path, args.feature_cache.split("/")[2],
+                "/".join(args.feature_cache.split("/")[3:]))
 
-    distances_matrix[np.isnan(distances_matrix)] = np.nanmean(distances_matrix)
-    
     '''
     Split data
     '''
     
     y = np.array(y).reshape(len(y), 1)
     X = np.concatenate((y, distances_matrix), axis=1)
-    np.random.shuffle(X)
+    np.random.RandomState(args.random_seed).shuffle(X)
     train, validation, test = np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
+
+    '''
+    Scaling
+
+    Fitted on the train rows only, the validation and test rows must not
+    leak into the training features or the evaluation.
+    '''
+    scaling = fit_scaling(train[:, 1:], mode=args.scaling, metrics=metrics)
+    logger.info("Scaling mode: %s.", scaling["mode"])
+
+    # clean null values if any, with the mean of the scaled train features
+    for split in (train, validation, test):
+        split[:, 1:] = scale_features(split[:, 1:], scaling)
     
     '''
     Saving data
@@ -159,11 +998,12 @@ if __name__ == "__main__":
     logger.info("Saving transformed data.")
     
     s3_client = boto3.client('s3')
+    columns = ["label"] + list(metrics)
 
     # train
     filepath = f"{base_dir}/train/"
     filename = f"train"
-    np.savetxt(filepath + filename + '.csv', train, delimiter=",")
+    save_split(train, filepath, filename, args.output_format, columns)
 
     # NOT NEEDED, sagamaker will do this for us
     # logger.info("Uploading data to bucket: %s, key: %s", bucket, filename + '.csv')
@@ -172,7 +1012,7 @@ if __name__ == "__main__":
     # validation
     filepath = f"{base_dir}/validation/"
     filename = f"validation"
-    np.savetxt(filepath + filename + '.csv', validation, delimiter=",")
+    save_split(validation, filepath, filename, args.output_format, columns)
 
     # logger.info("Uploading data to bucket: %s, key: %s", bucket, filename + '.csv')
     # s3_client.upload_file(filepath + filename + '.csv', bucket, filename + '.csv')
@@ -180,11 +1020,15 @@ if __name__ == "__main__":
     # test
     filepath = f"{base_dir}/test/"
     filename = f"test"
-    np.savetxt(filepath + filename + '.csv', test, delimiter=",")
+    save_split(test, filepath, filename, args.output_format, columns)
 
     # logger.info("Uploading data to bucket: %s, key: %s", bucket, filename + '.csv')
     # s3_client.upload_file(filepath + filename + '.csv', bucket, filename + '.csv')
 
+    # scaling parameters, for serving and evaluation
+    for split in ("train", "validation", "test"):
+        save_scaling(scaling, f"{base_dir}/{split}/scaler.json")
+
     logger.info("Data saved.")
 
     logger.info("End preprocessing.")
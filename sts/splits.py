@@ -0,0 +1,27 @@
+"""Read the dataset splits written by preprocess.py
+
+Used by training.py, which runs with the sts directory as its source_dir,
+and by the evaluate.py and baseline.py processing scripts, which are
+uploaded alone and get this module as a ProcessingInput (see pipeline.py).
+"""
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def load_split(directory, name):
+    """Load a dataset written by preprocess.py, labels in the first column
+
+    The binary .npy file is memory-mapped when its manifest is present,
+    otherwise the CSV file is parsed.
+    """
+    manifest_path = os.path.join(directory, f"{name}.manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return np.load(
+            os.path.join(directory, manifest["file"]), mmap_mode="r")
+    return pd.read_csv(
+        os.path.join(directory, f"{name}.csv"), header=None).values
@@ -1,6 +1,7 @@
 """Load and prepare sts dataset."""
 
 import os
+import shutil
 import pickle
 import pathlib
 import boto3
@@ -16,12 +17,16 @@ from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.linear_model import LogisticRegression
 import joblib
 
+from compiled import export_linear_model, check_parity, LinearPredictor
+from splits import load_split
+
 warnings.filterwarnings(action='ignore')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+
 # main routine
 if __name__ == "__main__":
     logger.debug("Starting modeling.")
@@ -31,13 +36,11 @@ if __name__ == "__main__":
     logger.debug("Reading train data.")
     train_path = os.environ.get('SM_CHANNEL_TRAIN')
     logger.info(run("ls "+train_path, shell=True))
-    df = pd.read_csv(train_path + "/train.csv", header=None)
-
+    train = load_split(train_path, "train")
 
-    # Extracting data from pandas DataFrame
-    Y_train = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_train = df.values
+    # Extracting labels and features
+    Y_train = np.asarray(train[:, 0])
+    X_train = np.asarray(train[:, 1:])
 
     logger.info("Starting model creation.")
     '''
@@ -56,4 +59,16 @@ if __name__ == "__main__":
     filename = os.path.join(os.environ.get('SM_MODEL_DIR'), "model.joblib")
     joblib.dump(logreg, filename)
 
+    # scaling parameters, needed to featurize raw sentence pairs when serving
+    scaler_path = os.path.join(train_path, "scaler.json")
+    if os.path.exists(scaler_path):
+        shutil.copy(scaler_path, os.environ.get('SM_MODEL_DIR'))
+
+    # plain NumPy version of the model for serving, must predict the same
+    compiled_filename = os.path.join(
+        os.environ.get('SM_MODEL_DIR'), "model.npz")
+    export_linear_model(logreg, compiled_filename)
+    check_parity(logreg, LinearPredictor.load(compiled_filename), X_train)
+    logger.info("Compiled model saved, predictions match sklearn.")
+
     logger.info("End modeling.")
@@ -1,22 +1,175 @@
-from sagemaker.s3 import S3Downloader
+from botocore.exceptions import ClientError
+from sagemaker.s3 import parse_s3_url
 import sagemaker
 import boto3
 import sagemaker.session
 import tempfile
+import hashlib
+import shutil
+import glob
 import pandas as pd
+import numpy as np
+import json
 import os
 
+# persistent cache of the S3 objects read by load_dataset
+DATASET_CACHE_DIR = os.getenv(
+    "STS_DATASET_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "sts", "datasets"))
+# bytes kept in the cache, the least recently used files are removed first
+DATASET_CACHE_MAX_BYTES = int(
+    os.getenv("STS_DATASET_CACHE_MAX_BYTES", str(2 * 2**30)))
+
+
+def _cache_name(s3_uri: str) -> str:
+    return hashlib.sha256(s3_uri.encode()).hexdigest()[:32]
+
+
+def _cached_versions(cache_dir: str, s3_uri: str) -> list:
+    """Cached files of a S3 object, the most recently used last"""
+    paths = [
+        path for path in glob.glob(
+            os.path.join(cache_dir, _cache_name(s3_uri) + "-*"))
+        if "." not in os.path.basename(path)]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def cached_s3_object(
+        s3_client, s3_uri: str, cache_dir: str, revalidate: bool = True):
+    """Local path of a S3 object from the cache, None if it does not exist
+
+    Files are named by a hash of the S3 URI and the ETag of the object, so
+    different objects never overwrite each other. Unless revalidate is
+    False, a conditional GET checks the ETag and downloads the object only
+    if it changed. Downloads go to a temporary file renamed when complete.
+    """
+    versions = _cached_versions(cache_dir, s3_uri)
+    cached = versions[-1] if versions else None
+    if cached and not revalidate:
+        os.utime(cached)
+        return cached
+
+    bucket, key = parse_s3_url(s3_uri)
+    conditions = {}
+    if cached:
+        conditions["IfNoneMatch"] = '"{}"'.format(
+            os.path.basename(cached).split("-", 1)[1])
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key, **conditions)
+    except ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code in ("304", "NotModified"):
+            os.utime(cached)
+            return cached
+        if code in ("404", "NoSuchKey"):
+            return None
+        raise
+
+    path = os.path.join(cache_dir, "{}-{}".format(
+        _cache_name(s3_uri), response["ETag"].strip('"')))
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(response["Body"], f, 2**20)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    # previous versions of the object and their binary copies
+    for old in versions:
+        for old_path in glob.glob(old + "*"):
+            os.remove(old_path)
+    return path
+
+
+def evict_dataset_cache(cache_dir: str, max_bytes: int, keep=()):
+    """Remove the least recently used files until max_bytes are left"""
+    files = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.startswith(".tmp-"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path not in keep:
+            os.remove(path)
+            total -= size
+
+
+def _binary_copy(csv_path: str, mmap: bool):
+    """Array of a cached CSV file, parsed once and kept as .npy next to it
+
+    None if the CSV file is not all numbers.
+    """
+    npy_path = csv_path + ".npy"
+    if not os.path.exists(npy_path):
+        values = pd.read_csv(csv_path, header=None).values
+        if values.dtype == object:
+            return None
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(csv_path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp_path, npy_path)
+    os.utime(npy_path)
+    return np.load(npy_path, mmap_mode="r" if mmap else None)
+
 
 def load_dataset(
-    s3_uri: str, filename: str, sagemaker_session=None
+    s3_uri: str, filename: str, sagemaker_session=None,
+    binary: bool = False, mmap: bool = False, revalidate: bool = True,
+    cache_dir: str = None
 ) -> pd.DataFrame:
-    """Load a data set from a S3 uri"""
-    S3Downloader.download(
-        s3_uri, tempfile.gettempdir(),
-        sagemaker_session=sagemaker_session)
-    dataset_filename = os.path.join(
-        tempfile.gettempdir(), filename)
-    return pd.read_csv(dataset_filename, header=None)
+    """Load a data set from a S3 uri
+
+    The objects are kept in a local cache (DATASET_CACHE_DIR, bounded by
+    DATASET_CACHE_MAX_BYTES) and only downloaded again if their ETag
+    changed, pass revalidate=False to skip that check.
+
+    If preprocess.py wrote the binary format next to the CSV file, for
+    example test.manifest.json for test.csv, the .npy file is loaded
+    instead of parsing the CSV text. Otherwise, with binary=True the CSV
+    file is parsed once and a binary copy is loaded the next times. With
+    mmap=True the binary data is memory-mapped, read only, instead of
+    read in memory.
+    """
+    session = sagemaker_session or sagemaker.session.Session()
+    # the session only has an s3_client when one was given to it
+    s3 = session.s3_client or session.boto_session.client(
+        "s3", region_name=session.boto_region_name)
+    cache_dir = cache_dir or DATASET_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    base_uri = s3_uri.rstrip("/")
+
+    def cached(name):
+        return cached_s3_object(
+            s3, f"{base_uri}/{name}", cache_dir, revalidate)
+
+    used = []
+    manifest_path = cached(
+        "{}.manifest.json".format(os.path.splitext(filename)[0]))
+    if manifest_path:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        array_path = cached(manifest["file"])
+        used = [manifest_path, array_path]
+        data = pd.DataFrame(
+            np.load(array_path, mmap_mode="r" if mmap else None))
+    else:
+        csv_path = cached(filename)
+        if csv_path is None:
+            raise FileNotFoundError(f"{base_uri}/{filename} does not exist")
+        used = [csv_path, csv_path + ".npy"]
+        values = _binary_copy(csv_path, mmap) if binary or mmap else None
+        if values is None:
+            data = pd.read_csv(csv_path, header=None)
+        else:
+            data = pd.DataFrame(values)
+
+    evict_dataset_cache(cache_dir, DATASET_CACHE_MAX_BYTES, keep=used)
+    return data
 
 
 def get_sm_session(
@@ -42,3 +195,22 @@ def get_sm_session(
     # sagemaker runtime client
     # sagemaker session
     return b3_session, sm_client, sm_runtime, sm_session
+
+
+def batch_inference_id(prefix: str, first: int, last: int) -> str:
+    """Inference id of a request with the rows first to last of a dataset
+
+    Rows are numbered from 1. A request with a single row is prefix and row
+    number, like sts_7, the same as before batching. A request with several
+    rows is prefix, first and last row, like sts_11-20, and the i-th line of
+    its input and output is the row first + i.
+    """
+    if first == last:
+        return f"{prefix}{first}"
+    return f"{prefix}{first}-{last}"
+
+
+def inference_rows(inference_id: str, prefix: str) -> range:
+    """Row numbers of a request, given its id from batch_inference_id"""
+    first, _, last = inference_id[len(prefix):].partition("-")
+    return range(int(first), int(last or first) + 1)
@@ -1,11 +1,35 @@
 """Send traffic to the endpoint
 
-This uses the test.csv dataset"""
-from sts.utils import load_dataset, get_sm_session
+This uses the test.csv dataset. Rows are sent by --concurrency threads,
+following a requests per second schedule:
+
+constant   --rate requests per second
+ramp       from --start-rate to --rate over --ramp-seconds, then constant
+burst      --burst-size requests at once, spaced so the average is --rate
+
+With --rate 0 (the default) requests are sent as fast as the threads allow.
+With --batch-size N each request carries N rows, the inference id of a
+request is built by sts.utils.batch_inference_id from its first and last
+row numbers (starting at 1): sts_7 for a single row, sts_11-20 for rows 11
+to 20, whatever order the responses arrive in, so gen_fake_ground_truth.py
+can join on it.
+
+Results are appended to a JSON lines file (--output) as they arrive, one
+line per row like {"sts_7": {"input": [...], "result": [...],
+"inference_id": "sts_7"}}, in the order the responses arrive. With
+--resume the rows already in the file are not sent again.
+"""
+from sts.utils import (
+    load_dataset, get_sm_session, batch_inference_id)
 from sagemaker.deserializers import CSVDeserializer
 from sagemaker.serializers import CSVSerializer
 from sagemaker.sklearn.model import SKLearnPredictor
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import numpy as np
+import threading
+import math
+import time
 import os
 import argparse
 import json
@@ -14,10 +38,148 @@ import progressbar
 
 load_dotenv()
 
+# upper bounds of the latency histogram buckets in ms
+_HISTOGRAM_BUCKETS_ = [5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def send_offsets(n_requests, schedule="constant", rate=0.0, start_rate=1.0,
+                 ramp_seconds=60.0, burst_size=10):
+    """Seconds from the start at which to send each request"""
+    if rate <= 0:
+        return np.zeros(n_requests)
+    i = np.arange(n_requests, dtype=np.float64)
+    if schedule == "constant":
+        return i / rate
+    if schedule == "burst":
+        return (i // burst_size) * burst_size / rate
+    if schedule == "ramp":
+        # requests sent by time t <= ramp_seconds with a linear rate:
+        # n(t) = start_rate * t + (rate - start_rate) * t**2 / (2 * T)
+        slope = (rate - start_rate) / ramp_seconds
+        ramp_requests = (start_rate + rate) / 2 * ramp_seconds
+        if slope == 0:
+            ramp = i / rate
+        else:
+            ramp = (np.sqrt(np.maximum(
+                start_rate**2 + 2 * slope * i, 0)) - start_rate) / slope
+        after = ramp_seconds + (i - ramp_requests) / rate
+        return np.where(i < ramp_requests, ramp, after)
+    raise ValueError(f"Unknown schedule {schedule}")
+
+
+def latency_histogram(latencies):
+    """Text histogram of latencies in seconds, with percentiles"""
+    ms = np.asarray(latencies) * 1000
+    counts, _ = np.histogram(ms, [0] + _HISTOGRAM_BUCKETS_ + [math.inf])
+    widest = max(counts.max(), 1)
+    lines = []
+    for upper, count in zip(_HISTOGRAM_BUCKETS_ + [math.inf], counts):
+        label = f"<= {upper} ms" if upper != math.inf else \
+            f"> {_HISTOGRAM_BUCKETS_[-1]} ms"
+        lines.append("{:>12} {:>7} {}".format(
+            label, count, "#" * int(round(40 * count / widest))))
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    lines.append(
+        f"p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, "
+        f"max {ms.max():.1f} ms")
+    return "\n".join(lines)
+
+
+class InferenceWriter:
+    """Append JSON lines to a file, flushed every few lines or seconds
+
+    Safe to call from several threads, each write call is written whole.
+    """
+
+    def __init__(self, path, append=False, flush_every=100,
+                 flush_seconds=5.0):
+        self._f = open(path, 'a' if append else 'w')
+        self._lock = threading.Lock()
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._pending = 0
+        self._flushed = time.monotonic()
+
+    def write(self, records):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self._lock:
+            self._f.write(lines)
+            self._pending += len(records)
+            if self._pending >= self.flush_every or \
+                    time.monotonic() - self._flushed >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+        self._flushed = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._f.close()
+
+    def __enter__(self):
+        return self
 
-def main(deploy_data, train_data):
+    def __exit__(self, *exc):
+        self.close()
+
+
+def written_rows(path):
+    """Row ids already in a results file, to resume an interrupted run
+
+    A last line cut by a crash is removed from the file.
+    """
+    rows = set()
+    if not os.path.exists(path):
+        return rows
+    with open(path, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            f.truncate(complete)
+    for line in data[:complete].splitlines():
+        if line.strip():
+            rows.update(json.loads(line))
+    return rows
+
+
+def send_traffic(invoke, indices, offsets, concurrency, on_done):
+    """Call invoke(index) for each request index at its offset
+
+    At most concurrency requests are in flight; when all are busy the next
+    ones are sent late. on_done(index, result, latency) is called from the
+    worker threads.
+    """
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def timed(index):
+        try:
+            start = time.perf_counter()
+            result = invoke(index)
+            on_done(index, result, time.perf_counter() - start)
+        finally:
+            slots.release()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = []
+        for index, offset in zip(indices, offsets):
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            slots.acquire()
+            futures.append(executor.submit(timed, index))
+        for future in futures:
+            # raise the errors of the requests
+            future.result()
+    return time.perf_counter() - start
+
+
+def main(deploy_data, train_data, args):
     inference_id_prefix = 'sts_'  # Comes from deploymodel.py
-    outputs = {'inferences': []}
 
     # AWS especific
     AWS_DEFAULT_REGION = os.getenv('AWS_DEFAULT_REGION', 'eu-west-1')
@@ -31,7 +193,8 @@ def main(deploy_data, train_data):
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY
     )
 
-    # Load a predictor using the endpoint name
+    # Load a predictor using the endpoint name, the boto3 client behind it
+    # can be shared by the threads
     predictor = SKLearnPredictor(
         deploy_data['endpoint']['name'],
         sagemaker_session=sm_session,
@@ -47,36 +210,88 @@ def main(deploy_data, train_data):
     # remove labels in the test dataset
     test_data.drop(test_data.columns[0], axis=1, inplace=True)
 
-    # Iterate over the test data and call the endpoint for each row, 
-    # stop for 2 seconds for rows divisible by 3, just to make time
     x_test_rows = test_data.values
+    batch_size = args.batch_size
+    n_requests = math.ceil(len(x_test_rows) / batch_size)
+
+    def row_id(row):
+        return '{}{}'.format(inference_id_prefix, row + 1)
+
+    def request_rows(index):
+        return range(
+            index * batch_size,
+            min((index + 1) * batch_size, len(x_test_rows)))
+
+    # requests with all their rows in the results file are not sent again,
+    # resume with the same --batch-size
+    done = written_rows(args.output) if args.resume else set()
+    indices = [
+        index for index in range(n_requests)
+        if not all(row_id(row) in done for row in request_rows(index))]
+    if done:
+        print(f"Resuming, {len(done)} rows already in {args.output}")
+    offsets = send_offsets(
+        len(indices), args.schedule, args.rate, args.start_rate,
+        args.ramp_seconds, args.burst_size)
+
+    def request_id(index):
+        # Auto-generate an inference-id to track the request/response
+        # in the captured data, from the row numbers so it does not depend
+        # on the order of the responses
+        first = index * batch_size + 1
+        last = min(first + batch_size - 1, len(x_test_rows))
+        return batch_inference_id(inference_id_prefix, first, last)
+
+    def invoke(index):
+        """Results of the rows of the request, one per row"""
+        if batch_size == 1:
+            return [predictor.predict(
+                x_test_rows[index], inference_id=request_id(index))]
+        # one line per row in the request and in the response
+        batch = x_test_rows[index * batch_size:(index + 1) * batch_size]
+        result = predictor.predict(batch, inference_id=request_id(index))
+        if len(result) != len(batch):
+            raise ValueError(
+                f"{request_id(index)}: {len(result)} predictions "
+                f"for {len(batch)} rows")
+        return [[row] for row in result]
+
+    latencies = []
+    lock = threading.Lock()
+
     print(
         f"Sending trafic to the endpoint: {deploy_data['endpoint']['name']}")
-    with progressbar.ProgressBar(max_value=len(x_test_rows)) as bar:
-        for index, x_test_row in enumerate(x_test_rows, start=1):
-            # Auto-generate an inference-id to track the request/response 
-            # in the captured data
-            inference_id = '{}{}'.format(inference_id_prefix, index)
-
-            result = predictor.predict(
-                x_test_row,
-                inference_id=inference_id
-            )
-
-            outputs['inferences'].append(
-                {
-                    inference_id: {
-                        'input': x_test_row.tolist(),
-                        'result': result
-                    }
-                }
-            )
-
-            # show progress
-            bar.update(index)
-    
-    with open('testendpoint_out.json', 'w') as f:
-        json.dump(outputs, f)
+    with InferenceWriter(args.output, append=args.resume,
+                         flush_every=args.flush_every,
+                         flush_seconds=args.flush_seconds) as writer, \
+            progressbar.ProgressBar(max_value=len(indices)) as bar:
+        def on_done(index, result, latency):
+            # one line per row, with the inference id of its request
+            records = []
+            for row, row_result in zip(request_rows(index), result):
+                entry = {} if args.no_inputs else {
+                    'input': x_test_rows[row].tolist()}
+                entry['result'] = row_result
+                entry['inference_id'] = request_id(index)
+                records.append({row_id(row): entry})
+            writer.write(records)
+            with lock:
+                latencies.append(latency)
+                bar.update(len(latencies))
+
+        elapsed = send_traffic(
+            invoke, indices, offsets, args.concurrency, on_done)
+
+    if latencies:
+        rows = sum(len(request_rows(index)) for index in indices)
+        print(latency_histogram(latencies))
+        print(
+            "{} requests of {} rows in {:.1f}s, {:.1f} requests/s, "
+            "{:.1f} rows/s, {:.2f} ms per row".format(
+                len(latencies), batch_size, elapsed,
+                len(latencies) / elapsed, rows / elapsed,
+                1000 * np.median(latencies) / batch_size))
+    print(f"Results saved to {args.output}")
 
 
 if __name__ == '__main__':
@@ -91,6 +306,55 @@ if __name__ == '__main__':
         default='trainmodel_out.json',
         help="JSON output from the train script"
     )
+    parser.add_argument(
+        "--concurrency", type=int, default=1,
+        help="requests in flight at the same time"
+    )
+    parser.add_argument(
+        "--schedule", type=str, default="constant",
+        choices=("constant", "ramp", "burst"),
+        help="how the requests per second change over time"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0,
+        help="target requests per second, 0 sends as fast as possible"
+    )
+    parser.add_argument(
+        "--start-rate", type=float, default=1,
+        help="requests per second at the start of a ramp"
+    )
+    parser.add_argument(
+        "--ramp-seconds", type=float, default=60,
+        help="duration of a ramp"
+    )
+    parser.add_argument(
+        "--burst-size", type=int, default=10,
+        help="requests sent at once in a burst"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="rows of test.csv sent in each request"
+    )
+    parser.add_argument(
+        "--output", type=str, default='testendpoint_out.jsonl',
+        help="JSON lines file for the results, a line per row"
+    )
+    parser.add_argument(
+        "--no-inputs", action='store_true',
+        help="do not write the input row of each result"
+    )
+    parser.add_argument(
+        "--resume", action='store_true',
+        help="append to --output, skipping the rows already in it"
+    )
+    parser.add_argument(
+        "--flush-every", type=int, default=100,
+        help="flush --output to disk after this many rows"
+    )
+    parser.add_argument(
+        "--flush-seconds", type=float, default=5,
+        help="or after this many seconds"
+    )
 
     args, _ = parser.parse_known_args()
     print(f"Using deploy info {args.deploymodel_output}")
@@ -101,4 +365,4 @@ if __name__ == '__main__':
     with open(args.trainmodel_output) as f:
         train_data = json.load(f)
 
-    main(deploy_data, train_data)
+    main(deploy_data, train_data, args)
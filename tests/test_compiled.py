@@ -0,0 +1,56 @@
+"""LinearPredictor against the sklearn model it is exported from"""
+import numpy as np
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+from sts.compiled import LinearPredictor, check_parity, export_linear_model
+
+
+def fitted_model(n_classes, dtype, seed=0):
+    """LogisticRegression on 23 features in [0, 1], like the splits
+
+    With float32 data, like the npy splits, recent sklearn versions keep
+    the coefficients and the decision function in float32.
+    """
+    rng = np.random.RandomState(seed)
+    X = rng.random_sample((600, 23)).astype(dtype)
+    bins = np.linspace(0, 3, n_classes + 1)[1:-1]
+    y = np.digitize(X[:, :3].sum(axis=1), bins)
+    model = LogisticRegression(max_iter=200)
+    return model.fit(X, y.astype(np.float64)), X
+
+
+@pytest.fixture(
+    params=[(2, np.float64), (4, np.float64), (2, np.float32),
+            (4, np.float32)],
+    ids=["binary-float64", "multiclass-float64", "binary-float32",
+         "multiclass-float32"])
+def exported(request, tmp_path):
+    model, X = fitted_model(*request.param)
+    path = str(tmp_path / "model.npz")
+    export_linear_model(model, path)
+    return model, LinearPredictor.load(path), X
+
+
+def test_predictor_matches_sklearn(exported):
+    model, predictor, X = exported
+    expected = model.decision_function(X)
+    # float32 inputs are compared at float32 precision
+    tolerance = 1e-9 if expected.dtype == np.float64 else 1e-5
+    np.testing.assert_allclose(
+        predictor.decision_function(X), expected,
+        rtol=tolerance, atol=tolerance)
+    np.testing.assert_array_equal(predictor.predict(X), model.predict(X))
+
+
+def test_check_parity_accepts_the_exported_model(exported):
+    model, predictor, X = exported
+    check_parity(model, predictor, X)
+
+
+def test_check_parity_rejects_a_different_model(exported):
+    model, predictor, X = exported
+    other = LinearPredictor(
+        predictor.coef_, predictor.intercept_ + 1e-6, predictor.classes_)
+    with pytest.raises(ValueError):
+        check_parity(model, other, X)
@@ -0,0 +1,47 @@
+"""Micro-batching of concurrent requests"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+
+from model_loader import MicroBatcher
+
+
+def recording_predict(sizes):
+    """Predictions equal to the first feature, records the batch sizes"""
+    lock = threading.Lock()
+
+    def predict(X):
+        with lock:
+            sizes.append(len(X))
+        time.sleep(0.002)
+        return X[:, 0].copy()
+    return predict
+
+
+def test_batches_do_not_exceed_max_size():
+    sizes = []
+    batcher = MicroBatcher(recording_predict(sizes), window=0.005, max_size=8)
+    rng = np.random.RandomState(0)
+    requests = [
+        np.arange(n, dtype=np.float64).reshape(-1, 1) + 100 * i
+        for i, n in enumerate(rng.randint(1, 4, size=300))]
+
+    with ThreadPoolExecutor(32) as executor:
+        results = list(executor.map(batcher.predict, requests))
+
+    for X, result in zip(requests, results):
+        np.testing.assert_array_equal(result, X[:, 0])
+    assert max(sizes) <= 8
+    assert sum(sizes) == sum(len(X) for X in requests)
+    # the requests were batched at all
+    assert len(sizes) < len(requests)
+
+
+def test_larger_request_is_predicted_alone():
+    sizes = []
+    batcher = MicroBatcher(recording_predict(sizes), window=0.005, max_size=4)
+    X = np.ones((10, 1))
+    np.testing.assert_array_equal(batcher.predict(X), X[:, 0])
+    assert sizes == [10]
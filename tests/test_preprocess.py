@@ -0,0 +1,159 @@
+"""Batched distance features against the original per pair computation
+
+The reference is the loop preprocess.py had before the batched kernels: a
+count vector per sentence over the vocabulary of the pair, and one
+pairwise_distances_argmin_min call per metric.
+"""
+import string
+import warnings
+
+import numpy as np
+import pytest
+from scipy.spatial import distance
+from sklearn.metrics import pairwise_distances_argmin_min
+
+from sts.preprocess import (
+    _BOOLEAN_METRICS_, _METRIC_SUBSETS_, _NUMERIC_METRICS_, _VALID_METRICS_,
+    boolean_distances,
+    distance_features, encode_pairs, featurize)
+
+_WORDS_ = ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def reference_distances(s1, s2, metric):
+    """Distance of a pair the way the original preprocess.py computed it"""
+    table = str.maketrans("", "", string.punctuation)
+    words1 = s1.translate(table).split()
+    words2 = s2.translate(table).split()
+    vocabulary = set(words1).union(words2)
+    u = np.array([[words1.count(w) for w in vocabulary]], dtype=np.int32)
+    v = np.array([[words2.count(w) for w in vocabulary]], dtype=np.int32)
+    kwargs = {}
+    if metric == 'seuclidean':
+        # the variances scipy estimated from the pair when sklearn gave no
+        # V, recent sklearn versions require it
+        kwargs["metric_kwargs"] = {
+            "V": np.var(np.vstack([u, v]), axis=0, ddof=1)}
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        # boolean conversion and 0/0 warnings of sklearn and scipy
+        warnings.simplefilter('ignore')
+        _, dist = pairwise_distances_argmin_min(
+            u, v, axis=1, metric=metric, **kwargs)
+    return dist[0]
+
+
+def metric_supported(metric):
+    """Metrics removed from recent sklearn/scipy, like kulsinski"""
+    try:
+        reference_distances("a b", "b c", metric)
+    except (ValueError, AttributeError):
+        return False
+    return True
+
+
+def random_pairs(n, seed=0):
+    """Pairs with repeated tokens, punctuation, identical and empty sides"""
+    rng = np.random.RandomState(seed)
+
+    def sentence():
+        words = rng.choice(_WORDS_, size=rng.randint(0, 7))
+        return " ".join(w + rng.choice(["", "", ",", "."]) for w in words)
+
+    pairs = [(sentence(), sentence()) for _ in range(n)]
+    pairs += [("a b b", "a b b"), ("a a", "a"), ("a", "b"), ("", "a b"),
+              ("c c c", ""), ("a b c", "d e f"), ("a b", "b a")]
+    return pairs
+
+
+@pytest.fixture(scope="module")
+def pairs():
+    return random_pairs(300)
+
+
+@pytest.fixture(scope="module")
+def features(pairs):
+    return featurize(pairs, _VALID_METRICS_)
+
+
+def check_metric(pairs, features, metric):
+    if not metric_supported(metric):
+        pytest.skip(f"{metric} is not supported by this sklearn/scipy")
+    column = features[:, _VALID_METRICS_.index(metric)]
+    for (s1, s2), value in zip(pairs, column):
+        if not (s1 + s2).translate(
+                str.maketrans("", "", string.punctuation)).split():
+            # the original loop fails on pairs without tokens
+            assert np.isnan(value)
+            continue
+        np.testing.assert_allclose(
+            value, reference_distances(s1, s2, metric),
+            rtol=1e-9, atol=1e-12, equal_nan=True,
+            err_msg=f"{metric} of {s1!r} and {s2!r}")
+
+
+@pytest.mark.parametrize("metric", sorted(_NUMERIC_METRICS_))
+def test_numeric_distances_match_original(pairs, features, metric):
+    check_metric(pairs, features, metric)
+
+
+@pytest.mark.parametrize("metric", sorted(_BOOLEAN_METRICS_))
+def test_boolean_distances_match_original(pairs, features, metric):
+    check_metric(pairs, features, metric)
+
+
+@pytest.mark.parametrize("metric", sorted(_BOOLEAN_METRICS_))
+def test_boolean_distances_match_scipy(pairs, metric):
+    func = getattr(distance, metric, None)
+    if func is None:
+        pytest.skip(f"{metric} is not in this scipy")
+    left, right, _ = encode_pairs(pairs)
+    column = boolean_distances(left, right, [metric])[:, 0]
+    for i, value in enumerate(column):
+        tokens = np.union1d(left[i].indices, right[i].indices)
+        if tokens.size == 0:
+            assert np.isnan(value)
+            continue
+        u = left[i][:, tokens].toarray().ravel() > 0
+        v = right[i][:, tokens].toarray().ravel() > 0
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter('ignore')
+            expected = func(u, v)
+        np.testing.assert_allclose(
+            value, expected, rtol=1e-9, atol=1e-12, equal_nan=True,
+            err_msg=f"{metric} of {pairs[i]!r}")
+
+
+def test_boolean_zero_divisions():
+    """jaccard and yule of scipy are 0 where their formula is 0/0"""
+    same = [("a b", "a b"), ("a a b", "b a")]
+    disjoint = [("a b", "c d")]
+    left, right, _ = encode_pairs(same + disjoint)
+    jaccard, yule = boolean_distances(left, right, ["jaccard", "yule"]).T
+    np.testing.assert_array_equal(jaccard, [0.0, 0.0, 1.0])
+    # no token only in one sentence: yule is 0, not nan
+    np.testing.assert_array_equal(yule[:2], [0.0, 0.0])
+    assert yule[2] == 2.0
+
+
+def test_hamming_compares_counts():
+    """hamming is numeric for sklearn, repeated tokens make a difference"""
+    left, right, _ = encode_pairs([("a a b", "a b"), ("a b", "a b")])
+    hamming = distance_features(left, right, ["hamming", "matching"])
+    np.testing.assert_array_equal(hamming[:, 0], [0.5, 0.0])
+    # the boolean version ignores the counts
+    np.testing.assert_array_equal(hamming[:, 1], [0.0, 0.0])
+
+
+def test_all_metrics_have_a_batched_kernel():
+    assert set(_VALID_METRICS_) == set(_NUMERIC_METRICS_) | set(
+        _BOOLEAN_METRICS_)
+
+
+def test_distinct_subset_has_no_duplicate_columns(pairs, features):
+    metrics = _METRIC_SUBSETS_['distinct']
+    columns = features[:, [_VALID_METRICS_.index(m) for m in metrics]]
+    columns = np.where(np.isnan(columns), -1.0, columns)
+    for i in range(len(metrics)):
+        for j in range(i + 1, len(metrics)):
+            assert not np.allclose(columns[:, i], columns[:, j]), \
+                f"{metrics[i]} and {metrics[j]} are the same feature"